@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+
+# Adaptive phi step scheduling
+#
+# A fixed one degree step spends most of a sweep on empty ceiling. The
+# stepper looks at each slice as it comes in and picks the next servo step:
+# big steps while slices are empty or barely change, small steps around
+# depth discontinuities and close range geometry. An optional point or time
+# budget makes sure the sweep finishes within what we can afford.
+
+import math
+import time
+
+import numpy
+
+
+class AdaptiveStepper:
+    '''
+    Picks the number of servo steps to take after each slice.
+
+    min_step/max_step bound the step size. A slice with fewer than
+    empty_frac good samples counts as empty. Consecutive slices whose
+    median relative range change is under similarity count as the same.
+    More than edge_frac of samples jumping by over discontinuity (relative)
+    between slices or between neighbouring samples counts as an edge. A
+    median range under near_range (mm) counts as close geometry.
+
+    point_budget caps the number of good samples in the sweep, time_budget
+    caps the sweep length in seconds. Either one forces bigger steps once
+    the sweep is on track to overrun it.
+    '''
+
+    def __init__(self, min_step: int=1, max_step: int=8,
+                 empty_frac: float=0.05, similarity: float=0.02,
+                 discontinuity: float=0.25, edge_frac: float=0.05,
+                 near_range: float=1000, min_range: int=20,
+                 max_phi: float=89, point_budget: int=None,
+                 time_budget: float=None):
+        assert 1 <= min_step <= max_step
+        self.min_step = min_step
+        self.max_step = max_step
+        self.empty_frac = empty_frac
+        self.similarity = similarity
+        self.discontinuity = discontinuity
+        self.edge_frac = edge_frac
+        self.near_range = near_range
+        self.min_range = min_range
+        self.max_phi = max_phi
+        self.point_budget = point_budget
+        self.time_budget = time_budget
+        self.reset()
+
+    def reset(self) -> None:
+        '''Forget everything, call at the start of a sweep'''
+        self.started = time.time()
+        self.prev = None
+        self.step = self.min_step
+        self.points = 0
+        self.slices = 0
+
+    def _relative_change(self, a, b, valid) -> numpy.ndarray:
+        a = a[valid].astype(numpy.float64)
+        b = b[valid].astype(numpy.float64)
+        return numpy.abs(a - b) / numpy.maximum(a, b)
+
+    def _content_step(self, ranges: numpy.ndarray, valid: numpy.ndarray) -> int:
+        '''Step size the slice itself asks for, ignoring any budget'''
+        if numpy.count_nonzero(valid) < self.empty_frac * len(ranges):
+            # Nothing here, get through it quickly
+            return self.max_step
+
+        good = ranges[valid]
+        if numpy.median(good) < self.near_range:
+            return self.min_step
+
+        # depth jumps between neighbouring samples in this slice
+        both = valid[1:] & valid[:-1]
+        in_slice = self._relative_change(ranges[1:], ranges[:-1], both)
+        if numpy.count_nonzero(in_slice > self.discontinuity) > \
+                self.edge_frac * len(ranges):
+            return self.min_step
+
+        if self.prev is None:
+            return self.min_step
+        # and between this slice and the last one
+        both = valid & (self.prev > self.min_range)
+        if not both.any():
+            # Something appeared or disappeared, take a closer look
+            return self.min_step
+        between = self._relative_change(ranges, self.prev, both)
+        if numpy.count_nonzero(between > self.discontinuity) > \
+                self.edge_frac * len(ranges):
+            return self.min_step
+        if numpy.median(between) < self.similarity:
+            # Same as the last slice, speed up gradually
+            return min(self.step * 2, self.max_step)
+        return self.step
+
+    def _budget_step(self, phi: float, n_points: int) -> int:
+        '''Smallest step that keeps us within budget'''
+        remaining_phi = self.max_phi - phi
+        step = self.min_step
+        if self.point_budget:
+            per_slice = max(self.points / self.slices, 1)
+            affordable = (self.point_budget - self.points) / per_slice
+            step = max(step, math.ceil(remaining_phi / max(affordable, 1)))
+        if self.time_budget:
+            per_slice = (time.time() - self.started) / self.slices
+            affordable = (self.time_budget - (time.time() - self.started)) / \
+                max(per_slice, 1e-6)
+            step = max(step, math.ceil(remaining_phi / max(affordable, 1)))
+        return step
+
+    def next_step(self, ranges: numpy.ndarray, phi: float) -> int:
+        '''Given the slice just taken at phi, return the next servo step'''
+        ranges = numpy.asarray(ranges)
+        valid = ranges > self.min_range
+        n_points = int(numpy.count_nonzero(valid))
+        self.points += n_points
+        self.slices += 1
+
+        step = self._content_step(ranges, valid)
+        # The budget wins over max_step, it's a hard limit
+        step = max(step, self._budget_step(phi, n_points))
+        # but never past the end of the sweep, the servo can't go there
+        step = min(step, max(self.min_step, math.ceil(self.max_phi - phi)))
+        self.prev = ranges
+        self.step = step
+        return step
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+
+# Benchmark a full Lidar.scan off device, using the replay backend
+#
+#   ./bench.py                              synthetic room
+#   ./bench.py --scan scan-1234.lscan       replay a recorded scan
+#   ./bench.py --sequential --repeat 3      old serial loop, 3 sweeps
+
+import argparse
+import json
+import logging
+import tempfile
+
+import adaptive
+import instrumentation
+import replay
+import scan
+import voxelfilter
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Run Lidar.scan end to end against replayed hardware')
+    parser.add_argument('--scan', help='recorded scan file to replay')
+    parser.add_argument('--scan-period', type=float, default=0.1,
+                        help='seconds per sensor scan')
+    parser.add_argument('--settle', type=float, default=0.05,
+                        help='seconds the servo takes to move')
+    parser.add_argument('--open-time', type=float, default=0.2,
+                        help='seconds to open the serial port')
+    parser.add_argument('--sequential', action='store_true',
+                        help='use the serial scan loop instead of the pipeline')
+    parser.add_argument('--adaptive', action='store_true',
+                        help='use adaptive phi steps')
+    parser.add_argument('--voxel', type=float,
+                        help='run the voxel filter with this voxel size (mm)')
+    parser.add_argument('--repeat', type=int, default=1)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    rig = replay.ReplayRig(args.scan, scan_period=args.scan_period,
+                           settle_time=args.settle, open_time=args.open_time)
+    # Don't litter the real scan directory
+    scan.Lidar.DATA_PATH = tempfile.mkdtemp(prefix='lidar-bench-')
+    metrics = instrumentation.SweepMetrics()
+    voxel_filter = voxelfilter.VoxelFilter(args.voxel) if args.voxel else None
+    lidar = scan.Lidar(metrics=metrics, backend=rig, pi=rig.pi,
+                       voxel_filter=voxel_filter)
+    logging.getLogger().setLevel(logging.WARNING)
+    try:
+        for i in range(args.repeat):
+            stepper = adaptive.AdaptiveStepper() if args.adaptive else None
+            lidar.scan(pipelined=not args.sequential, stepper=stepper,
+                       draw_preview=False)
+            summary = metrics.summary()
+            print(json.dumps(summary, indent=2))
+            print('Sweep {}: {} slices in {:.2f}s ({:.2f} slices/s)'.format(
+                i, summary['slices'], summary['duration'],
+                summary['slices_per_sec']))
+    finally:
+        lidar.close()
+
+
+if __name__ == '__main__':
+    main()
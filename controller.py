@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+
+# Pipelined scan controller
+#
+# Lidar.scan on its own is strictly serial: grab a slice, convert and save
+# it, move the servo, wait, repeat. The controller splits this into two
+# stages running at the same time:
+#
+#   motion:     grab slice k, move servo to k+1, wait for it to settle,
+#               grab slice k+1, ...
+#   processing: convert and persist slice k while the servo is moving
+#
+# Slices are handed between the stages through a bounded queue, if
+# processing falls behind the motion stage blocks until it catches up.
+
+import asyncio
+import concurrent.futures
+import logging
+import time
+
+
+class SettleTime:
+    '''
+    How long to wait for the servo to settle after moving a given number of
+    steps. Exact step sizes can be given in table, anything else falls back
+    to a linear model of base + per_step * steps.
+    '''
+
+    def __init__(self, base: float=0.02, per_step: float=0.005, table=None):
+        self.base = base
+        self.per_step = per_step
+        self.table = table or {}
+
+    def __call__(self, steps: int) -> float:
+        if steps in self.table:
+            return self.table[steps]
+        return self.base + self.per_step * abs(steps)
+
+
+class ScanController:
+    '''
+    Runs a sweep on a Lidar, overlapping servo motion and settling with slice
+    processing. The Lidar must already have its scan file open and its
+    sensor session started, Lidar.scan(pipelined=True) takes care of that.
+    '''
+
+    def __init__(self, lidar, settle_time=None, queue_len: int=4,
+                 stepper=None):
+        self.lidar = lidar
+        # adaptive.AdaptiveStepper, or None for fixed one degree steps
+        self.stepper = stepper
+        self.settle_time = settle_time or lidar.settle_time
+        self.queue_len = queue_len
+        # One thread each, so each stage stays in order
+        self._motion = concurrent.futures.ThreadPoolExecutor(1)
+        self._processing = concurrent.futures.ThreadPoolExecutor(1)
+
+    def next_step(self, ranges, phi: float) -> int:
+        '''Number of servo steps to take after a slice'''
+        if self.stepper:
+            return self.stepper.next_step(ranges, phi)
+        return 1
+
+    async def _move(self, steps: int, idx: int) -> float:
+        '''Move the servo and wait for it to settle, returns when it settled'''
+        loop = asyncio.get_event_loop()
+        metrics = self.lidar.metrics
+        with metrics.timed(idx, 'move'):
+            await loop.run_in_executor(
+                self._motion, self.lidar.servo.increment, steps)
+        with metrics.timed(idx, 'settle'):
+            await asyncio.sleep(self.settle_time(steps))
+        return time.time()
+
+    async def _acquire(self, since: float):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(
+            self._motion, self.lidar.session.get_slice, since)
+
+    async def _process(self, slices: asyncio.Queue) -> None:
+        loop = asyncio.get_event_loop()
+        while True:
+            item = await slices.get()
+            if item is None:
+                return
+            await loop.run_in_executor(
+                self._processing, self.lidar.process_slice, *item)
+            self.lidar.metrics.end_slice(item[2])
+
+    async def _hand_off(self, slices: asyncio.Queue, processing, item) -> bool:
+        '''
+        Queue item for processing, waiting if the queue is full. Returns
+        False if processing died instead of making room.
+        '''
+        put = asyncio.ensure_future(slices.put(item))
+        await asyncio.wait({put, processing},
+                           return_when=asyncio.FIRST_COMPLETED)
+        if not put.done():
+            put.cancel()
+            return False
+        return True
+
+    async def _sweep(self) -> None:
+        slices = asyncio.Queue(maxsize=self.queue_len)
+        processing = asyncio.ensure_future(self._process(slices))
+        servo = self.lidar.servo
+        metrics = self.lidar.metrics
+        settled_at = self.lidar.moved_at
+        try:
+            while servo.phase_angle < self.lidar.MAX_PHI:
+                phi = servo.phase_angle
+                logging.info('Scanning horizon at phi: {:.2f} deg'.format(phi))
+                # finished by both the motion and processing stages
+                idx = metrics.begin_slice(phi, stages=2)
+                with metrics.timed(idx, 'acquire'):
+                    ranges = await self._acquire(settled_at)
+                if not await self._hand_off(slices, processing, (ranges, phi, idx)):
+                    break
+                # slice k is processed while we move to k+1
+                settled_at = await self._move(self.next_step(ranges, phi), idx)
+                self.lidar.moved_at = settled_at
+                metrics.end_slice(idx)
+        finally:
+            # Let processing finish whatever was already captured
+            if not processing.done():
+                await self._hand_off(slices, processing, None)
+            await processing
+
+    def run(self) -> None:
+        '''Run a full sweep'''
+        start = time.time()
+        try:
+            asyncio.run(self._sweep())
+        finally:
+            self._motion.shutdown()
+            self._processing.shutdown()
+        logging.info('Pipelined sweep took {:.2f}s'.format(time.time() - start))
@@ -1,22 +1,208 @@
 #!/usr/bin/env python3
 
-# Convert pickled data produced by scan to .xyz format for mesh generation
+# Convert scan files (or old pickled data) produced by scan to a point cloud
+# format for mesh generation. Supports .xyz, binary .ply and binary .pcd.
+#
+# Usage:
+#   ./convert.py scan-1234.lscan           one scan to .xyz
+#   ./convert.py -f ply scan-1234.lscan    one scan to .ply
+#   ./convert.py -j 4 /etc/data/scans      every scan in a directory
+#   ./convert.py                           every scan in scanfile.DATA_PATH
 
+import argparse
+import multiprocessing
+import os
 import pickle
-import sys
+
+import numpy
+
+import scanfile
+
+FORMATS = ['xyz', 'ply', 'pcd']
+# Number of points formatted/written at a time
+CHUNK_POINTS = 1 << 16
+
+
+def is_legacy_scan(path: str) -> bool:
+    '''Old pickled scans are named scan-<time>, with no extension'''
+    name = os.path.basename(path)
+    return name.startswith('scan-') and '.' not in name
+
+
+def load_chunks(path: str):
+    '''
+    Return the number of points in a scan and an iterator over chunks of
+    its points, without having to hold the whole cloud in memory. Raises
+    ValueError if path isn't a readable scan.
+    '''
+    if os.path.getsize(path) == 0:
+        raise ValueError('{} is empty'.format(path))
+    if path.endswith(scanfile.EXTENSION) or scanfile.ScanFile.is_scan_file(path):
+        scan = scanfile.ScanFile(path)
+        return scan.count(), scan.iter_points()
+    if not is_legacy_scan(path):
+        raise ValueError('{} is not a {} scan file'.format(path, scanfile.EXTENSION))
+    # Old pickle format, a list of (x, y, z) tuples
+    try:
+        with open(path, 'rb') as binfile:
+            data = numpy.asarray(pickle.load(binfile), dtype=numpy.float64)
+    except (EOFError, pickle.UnpicklingError, ValueError, TypeError) as e:
+        raise ValueError('{} is not a readable scan: {}'.format(path, e))
+    data = data.reshape(-1, 3)
+    return len(data), (data[i:i + CHUNK_POINTS]
+                       for i in range(0, len(data), CHUNK_POINTS))
+
+
+def rechunk(chunks):
+    '''Split up chunks bigger than CHUNK_POINTS'''
+    for chunk in chunks:
+        for i in range(0, len(chunk), CHUNK_POINTS):
+            yield chunk[i:i + CHUNK_POINTS]
+
+
+def to_xyz(data) -> str:
+    '''Format an (n, 3) array as .xyz lines'''
+    data = numpy.asarray(data, dtype=numpy.float64).reshape(-1, 3)
+    # One big % instead of a format call per point
+    return ('%.2f %.2f %.2f\n' * len(data)) % tuple(data.ravel())
+
+
+def write_xyz(f, count: int, chunks) -> None:
+    for chunk in rechunk(chunks):
+        f.write(to_xyz(chunk).encode('ascii'))
+
+
+def write_ply(f, count: int, chunks, faces=None) -> None:
+    '''
+    Binary little endian PLY. faces is an optional (n, 3) array of vertex
+    indices of triangles.
+    '''
+    header = (
+        'ply\n'
+        'format binary_little_endian 1.0\n'
+        'element vertex {}\n'
+        'property float x\n'
+        'property float y\n'
+        'property float z\n').format(count)
+    if faces is not None:
+        header += (
+            'element face {}\n'
+            'property list uchar int vertex_indices\n').format(len(faces))
+    f.write((header + 'end_header\n').encode('ascii'))
+    for chunk in rechunk(chunks):
+        f.write(chunk.astype('<f4').tobytes())
+    if faces is not None:
+        rows = numpy.empty(len(faces), dtype=[('n', 'u1'), ('v', '<i4', (3,))])
+        rows['n'] = 3
+        rows['v'] = faces
+        f.write(rows.tobytes())
+
+
+def write_pcd(f, count: int, chunks) -> None:
+    f.write((
+        'VERSION .7\n'
+        'FIELDS x y z\n'
+        'SIZE 4 4 4\n'
+        'TYPE F F F\n'
+        'COUNT 1 1 1\n'
+        'WIDTH {0}\n'
+        'HEIGHT 1\n'
+        'VIEWPOINT 0 0 0 1 0 0 0\n'
+        'POINTS {0}\n'
+        'DATA binary\n').format(count).encode('ascii'))
+    for chunk in rechunk(chunks):
+        f.write(chunk.astype('<f4').tobytes())
+
+
+WRITERS = {'xyz': write_xyz, 'ply': write_ply, 'pcd': write_pcd}
+
+
+def output_path(path: str, fmt: str) -> str:
+    return path + '.' + fmt
+
+
+def is_up_to_date(path: str, fmt: str) -> bool:
+    out = output_path(path, fmt)
+    return os.path.exists(out) and \
+        os.path.getmtime(out) >= os.path.getmtime(path)
+
+
+def convert(path: str, fmt: str='xyz') -> str:
+    '''
+    Convert one scan, returns the output path. Output is written to a temp
+    file first so a half written file never looks up to date.
+    '''
+    out = output_path(path, fmt)
+    tmp = out + '.tmp'
+    count, chunks = load_chunks(path)
+    with open(tmp, 'wb') as f:
+        WRITERS[fmt](f, count, chunks)
+    os.replace(tmp, out)
+    return out
+
+
+def _convert_star(args):
+    '''Pool worker, returns (scan, output path or None, error or None)'''
+    try:
+        return args[0], convert(*args), None
+    except (OSError, ValueError) as e:
+        return args[0], None, e
+
+
+def find_scans(directory: str):
+    '''All scans in a directory, both new scan files and old pickles'''
+    scans = []
+    for name in sorted(os.listdir(directory)):
+        if not name.startswith('scan-'):
+            continue
+        path = os.path.join(directory, name)
+        if name.endswith(scanfile.EXTENSION) or is_legacy_scan(path):
+            scans.append(path)
+    return scans
+
+
+def convert_dir(directory: str=scanfile.DATA_PATH, fmt: str='xyz',
+                processes: int=None, force: bool=False):
+    '''
+    Convert every scan in directory that doesn't have an up to date output
+    already, fanned out over a process pool. Scans that can't be read are
+    reported and skipped, returns the outputs of the rest.
+    '''
+    scans = [s for s in find_scans(directory)
+             if force or not is_up_to_date(s, fmt)]
+    print('Converting {} scans in {}...'.format(len(scans), directory))
+    if not scans:
+        return []
+    with multiprocessing.Pool(processes) as p:
+        outputs = []
+        for scan, out, error in p.imap_unordered(
+                _convert_star, [(s, fmt) for s in scans]):
+            if error:
+                print('Skipping {}: {}'.format(scan, error))
+                continue
+            print(out)
+            outputs.append(out)
+    return outputs
+
 
 def main():
-    with open(sys.argv[1], 'rb') as binfile:
-        bindata = binfile.read()
-    with open(sys.argv[1] + '.xyz', 'w') as outfile:
-        outfile.write(to_xyz(bindata))
-
-def to_xyz(bindata) -> str:
-    data = pickle.loads(bindata)
-    strbuilder = ''
-    for (x, y, z) in data:
-        strbuilder += "{:.2f} {:.2f} {:.2f}\n".format(x, y, z)
-    return strbuilder
+    parser = argparse.ArgumentParser(
+        description="Convert scans to .xyz, .ply or .pcd point clouds")
+    parser.add_argument('paths', nargs='*', default=[scanfile.DATA_PATH],
+                        help='scan files or directories of scans')
+    parser.add_argument('-f', '--format', choices=FORMATS, default='xyz')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='worker processes for directories')
+    parser.add_argument('--force', action='store_true',
+                        help='convert even if the output is up to date')
+    args = parser.parse_args()
+
+    for path in args.paths:
+        if os.path.isdir(path):
+            convert_dir(path, args.format, args.jobs, args.force)
+        else:
+            print(convert(path, args.format))
+
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+
+# Per slice latency and throughput metrics for the scanner
+#
+# Each slice gets a record of how long each stage took (acquire, convert,
+# filter, write, move, settle) and how many bad samples it had. At the end of a sweep
+# the records are rolled up into a JSON summary. Optionally each finished
+# record is also appended as a JSON line to a rolling file, so a dashboard
+# can tail it while the scan runs.
+#
+# NullMetrics has the same interface and does nothing, it's what the scanner
+# uses when metrics are off so the hot path stays cheap.
+
+import contextlib
+import json
+import threading
+import time
+
+import numpy
+
+# Timed stages, in seconds
+STAGES = ['acquire', 'convert', 'filter', 'write', 'move', 'settle']
+# Per slice counters
+COUNTERS = ['points', 'bad_samples']
+_NULL = contextlib.nullcontext()
+
+
+class _Timer:
+    '''Adds the time spent inside the with block to record[name]'''
+    __slots__ = ['record', 'name', 'start']
+
+    def __init__(self, record: dict, name: str):
+        self.record = record
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *args):
+        self.record[self.name] = self.record.get(self.name, 0) + \
+            time.perf_counter() - self.start
+
+
+class SweepMetrics:
+    '''
+    Collects per slice records. A slice record is started with begin_slice
+    and emitted once end_slice has been called once per stage that touches
+    it, so the motion and processing stages of the pipelined controller can
+    each finish their part in their own time.
+    '''
+
+    def __init__(self, rolling_path: str=None):
+        self.rolling_path = rolling_path
+        # Things that happen once per session, not per slice (port open)
+        self.session = {}
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        '''Start a new sweep'''
+        self.started = time.time()
+        self.records = []
+        self._open = {}
+        self._pending = {}
+
+    def timed_session(self, name: str):
+        return _Timer(self.session, name)
+
+    def begin_slice(self, phi: float, stages: int=1) -> int:
+        with self._lock:
+            idx = len(self.records) + len(self._open)
+            self._open[idx] = {'slice': idx, 'phi': phi, 'time': time.time()}
+            self._pending[idx] = stages
+        return idx
+
+    def timed(self, idx: int, name: str):
+        if idx is None:
+            return _NULL
+        return _Timer(self._open[idx], name)
+
+    def count(self, idx: int, name: str, n: int) -> None:
+        if idx is None:
+            return
+        record = self._open[idx]
+        record[name] = record.get(name, 0) + n
+
+    def end_slice(self, idx: int) -> None:
+        if idx is None:
+            return
+        with self._lock:
+            self._pending[idx] -= 1
+            if self._pending[idx]:
+                return
+            del self._pending[idx]
+            record = self._open.pop(idx)
+            self.records.append(record)
+        if self.rolling_path:
+            with open(self.rolling_path, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+
+    def summary(self) -> dict:
+        '''Roll the slice records up into per stage stats'''
+        duration = time.time() - self.started
+        summary = {
+            'slices': len(self.records),
+            'duration': duration,
+            'slices_per_sec': len(self.records) / duration if duration else 0,
+            'session': dict(self.session),
+        }
+        for name in COUNTERS:
+            summary[name] = sum(r.get(name, 0) for r in self.records)
+        for name in STAGES:
+            values = numpy.array([r[name] for r in self.records if name in r])
+            if not len(values):
+                continue
+            summary[name] = {
+                'total': float(values.sum()),
+                'mean': float(values.mean()),
+                'p50': float(numpy.percentile(values, 50)),
+                'p95': float(numpy.percentile(values, 95)),
+                'max': float(values.max()),
+            }
+        return summary
+
+    def write_summary(self, path: str) -> dict:
+        summary = self.summary()
+        with open(path, 'w') as f:
+            json.dump(summary, f, indent=2)
+        return summary
+
+
+class NullMetrics:
+    '''Metrics turned off'''
+
+    def reset(self) -> None:
+        pass
+
+    def timed_session(self, name: str):
+        return _NULL
+
+    def begin_slice(self, phi: float, stages: int=1) -> None:
+        return None
+
+    def timed(self, idx: int, name: str):
+        return _NULL
+
+    def count(self, idx: int, name: str, n: int) -> None:
+        pass
+
+    def end_slice(self, idx: int) -> None:
+        pass
+
+    def write_summary(self, path: str) -> None:
+        return None
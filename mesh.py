@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+# Mesh a scan straight from its slice grid
+#
+# A scan is already an organized grid: one row per phi slice, one column per
+# theta step. Neighbouring samples in the grid are neighbours on the surface,
+# so each grid cell gives two triangles and no surface reconstruction is
+# needed. Triangles touching a bad sample, or spanning a depth jump (an
+# object edge in front of a wall), are dropped.
+#
+#   ./mesh.py scan-1234.lscan -o ../data/wall.ply
+#
+# The output PLY has the vertex/face layout graph_constructor.generate_graph
+# reads.
+
+import argparse
+
+import numpy
+
+import convert
+import scanfile
+
+
+def grid_faces(ranges: numpy.ndarray, valid: numpy.ndarray,
+               max_jump: float=0.1) -> numpy.ndarray:
+    '''
+    Triangulate an organized (slices, steps) range grid. Vertices are
+    numbered in row major order over the valid samples only. A triangle is
+    dropped if any corner is bad, or if its ranges differ by more than
+    max_jump relative to the closest one. Returns (n, 3) vertex indices.
+    '''
+    # vertex id of every valid sample, -1 for bad ones
+    ids = numpy.full(ranges.shape, -1, dtype=numpy.int64)
+    ids[valid] = numpy.arange(numpy.count_nonzero(valid))
+    r = ranges.astype(numpy.float64)
+
+    # corners of every grid cell
+    a = (slice(None, -1), slice(None, -1))
+    b = (slice(None, -1), slice(1, None))
+    c = (slice(1, None), slice(None, -1))
+    d = (slice(1, None), slice(1, None))
+
+    faces = []
+    for tri in [(a, b, c), (b, d, c)]:
+        corner_r = numpy.stack([r[corner] for corner in tri])
+        keep = numpy.all(numpy.stack([valid[corner] for corner in tri]), axis=0)
+        near = corner_r.min(axis=0)
+        far = corner_r.max(axis=0)
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            keep &= (far - near) <= max_jump * near
+        faces.append(numpy.stack([ids[corner][keep] for corner in tri], axis=1))
+    return numpy.concatenate(faces)
+
+
+def mesh_scan(scan: scanfile.ScanFile, max_jump: float=0.1):
+    '''Returns the vertices and faces of a scan file'''
+    valid = numpy.asarray(scan.valid)
+    faces = grid_faces(numpy.asarray(scan.ranges), valid, max_jump)
+    return scan.points(), faces
+
+
+def write_mesh(scan_path: str, out_path: str, max_jump: float=0.1) -> int:
+    '''Mesh a scan file to a binary PLY, returns the number of faces'''
+    vertices, faces = mesh_scan(scanfile.ScanFile(scan_path), max_jump)
+    with open(out_path, 'wb') as f:
+        convert.write_ply(f, len(vertices), [vertices], faces)
+    return len(faces)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Mesh a scan to a PLY')
+    parser.add_argument('scan')
+    parser.add_argument('-o', '--output', help='default: <scan>.ply')
+    parser.add_argument('--max-jump', type=float, default=0.1,
+                        help='max relative range difference in a triangle')
+    args = parser.parse_args()
+    out = args.output or args.scan + '.ply'
+    n_faces = write_mesh(args.scan, out, args.max_jump)
+    print('Wrote {} faces to {}'.format(n_faces, out))
+
+
+if __name__ == '__main__':
+    main()
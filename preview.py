@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+
+# Scan preview rendering
+#
+# Drawing every point of a sweep with matplotlib on the pi is slow and can
+# run it out of memory, so previews are rendered in a separate (niced)
+# process from a decimated copy of the cloud, and saved next to the scan:
+#
+#   scan-1234.lscan -> scan-1234-3d.png, scan-1234-top.png, scan-1234-range.png
+#
+# Can also be run by hand: ./preview.py scan-1234.lscan --projection top
+
+import argparse
+import logging
+import multiprocessing
+import os
+
+import numpy
+
+import scanfile
+
+PROJECTIONS = ['3d', 'top', 'range']
+
+
+def decimate(points: numpy.ndarray, voxel: float=None,
+             max_points: int=20000) -> numpy.ndarray:
+    '''
+    Keep one point per voxel (if voxel is given, in mm), then randomly
+    subsample down to max_points
+    '''
+    if voxel and len(points):
+        keys = numpy.floor(points / voxel).astype(numpy.int64)
+        _, first = numpy.unique(keys, axis=0, return_index=True)
+        points = points[numpy.sort(first)]
+    if max_points and len(points) > max_points:
+        pick = numpy.random.default_rng(0).choice(
+            len(points), max_points, replace=False)
+        points = points[numpy.sort(pick)]
+    return points
+
+
+def output_path(scan_path: str, projection: str) -> str:
+    return os.path.splitext(scan_path)[0] + '-' + projection + '.png'
+
+
+def draw_3d(ax, scan, points) -> None:
+    ax.set_xlabel('X in mm')
+    ax.set_ylabel('Y in mm')
+    ax.set_zlabel('Z in mm')
+    # draw our position
+    ax.scatter([0], [0], [0], c='b', marker='^')
+    ax.scatter(points[:, 0], points[:, 1], points[:, 2], c='r', marker='.', s=1)
+
+
+def draw_top(ax, scan, points) -> None:
+    ax.set_xlabel('X in mm')
+    ax.set_ylabel('Y in mm')
+    ax.set_aspect('equal')
+    ax.scatter([0], [0], c='b', marker='^')
+    sc = ax.scatter(points[:, 0], points[:, 1], c=points[:, 2], marker='.', s=1)
+    ax.figure.colorbar(sc, ax=ax, label='Z in mm')
+
+
+def draw_range(ax, scan, points) -> None:
+    '''Raw ranges as an image, one row per slice'''
+    ranges = numpy.ma.masked_less_equal(scan.ranges, scan.min_range)
+    phi = scan.phi
+    extent = [scan.theta[0], scan.theta[-1],
+              phi[-1] if len(phi) else 0, phi[0] if len(phi) else 0]
+    im = ax.imshow(ranges, aspect='auto', extent=extent)
+    ax.set_xlabel('theta in deg')
+    ax.set_ylabel('phi in deg')
+    ax.figure.colorbar(im, ax=ax, label='range in mm')
+
+
+DRAW = {'3d': draw_3d, 'top': draw_top, 'range': draw_range}
+
+
+def render(scan_path: str, projections=PROJECTIONS, voxel: float=20,
+           max_points: int=20000, nice: int=10):
+    '''Render the requested projections of a scan file to png'''
+    if nice:
+        os.nice(nice)
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    from mpl_toolkits.mplot3d import Axes3D
+    plt.ioff()
+
+    scan = scanfile.ScanFile(scan_path)
+    # Decimate chunk by chunk so the full cloud is never in memory
+    points = numpy.concatenate(
+        [decimate(chunk, voxel, None) for chunk in scan.iter_points()] +
+        [numpy.empty((0, 3))])
+    points = decimate(points, voxel, max_points)
+
+    outputs = []
+    for projection in projections:
+        fig = plt.figure()
+        ax = fig.add_subplot(
+            111, projection='3d' if projection == '3d' else None)
+        DRAW[projection](ax, scan, points)
+        out = output_path(scan_path, projection)
+        fig.savefig(out)
+        plt.close(fig)
+        outputs.append(out)
+        logging.info('Wrote preview %s', out)
+    return outputs
+
+
+def start(scan_path: str, **kwargs) -> multiprocessing.Process:
+    '''Render previews of a scan in the background, returns the process'''
+    p = multiprocessing.Process(
+        target=render, args=(scan_path,), kwargs=kwargs, name='preview')
+    p.start()
+    return p
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Render scan previews')
+    parser.add_argument('scan')
+    parser.add_argument('--projection', choices=PROJECTIONS, action='append')
+    parser.add_argument('--voxel', type=float, default=20,
+                        help='voxel size in mm for decimation')
+    parser.add_argument('--max-points', type=int, default=20000)
+    args = parser.parse_args()
+    for out in render(args.scan, args.projection or PROJECTIONS,
+                      args.voxel, args.max_points, nice=0):
+        print(out)
+
+
+if __name__ == '__main__':
+    main()
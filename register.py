@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+
+# Multi scan registration and merging
+#
+# Each run of the scanner gives a cloud in the frame of wherever the scanner
+# was sitting. This aligns a set of scans into the frame of the first one
+# with point to plane ICP, coarse to fine over a few voxel sizes, then merges
+# them and removes duplicate points where the scans overlap.
+#
+#   ./register.py scan-1.lscan scan-2.lscan scan-3.lscan -o wall.ply
+#
+# Scans should be given in an order where each one overlaps the ones before
+# it, every scan is registered against everything merged so far.
+
+import argparse
+import json
+
+import numpy
+from scipy.spatial import cKDTree
+
+import convert
+import voxelfilter
+
+
+def load_points(path: str) -> numpy.ndarray:
+    '''Every good point of a scan file (or old pickle) as an (n, 3) array'''
+    count, chunks = convert.load_chunks(path)
+    return numpy.concatenate(list(chunks) + [numpy.empty((0, 3))])
+
+
+def voxel_downsample(points: numpy.ndarray, voxel: float) -> numpy.ndarray:
+    '''Replace the points in each voxel with their centroid'''
+    if not len(points):
+        return points
+    keys = voxelfilter.pack_voxels(numpy.floor(points / voxel))
+    _, inverse, counts = numpy.unique(
+        keys, return_inverse=True, return_counts=True)
+    sums = numpy.stack([
+        numpy.bincount(inverse, weights=points[:, axis], minlength=len(counts))
+        for axis in range(3)], axis=1)
+    return sums / counts[:, None]
+
+
+def estimate_normals(points: numpy.ndarray, tree: cKDTree, k: int=10) -> numpy.ndarray:
+    '''Normals from the covariance of the k nearest neighbours of each point'''
+    k = min(k, len(points))
+    _, idx = tree.query(points, k)
+    neighbors = points[idx.reshape(len(points), -1)]
+    centered = neighbors - neighbors.mean(axis=1, keepdims=True)
+    cov = numpy.einsum('nki,nkj->nij', centered, centered)
+    # eigh sorts eigenvalues ascending, the normal is the smallest one
+    _, vectors = numpy.linalg.eigh(cov)
+    return vectors[:, :, 0]
+
+
+def rotation(rx: float, ry: float, rz: float) -> numpy.ndarray:
+    '''Rotation matrix from a rotation vector (Rodrigues)'''
+    axis = numpy.array([rx, ry, rz])
+    angle = numpy.linalg.norm(axis)
+    if angle < 1e-12:
+        return numpy.eye(3)
+    axis /= angle
+    K = numpy.array([[0, -axis[2], axis[1]],
+                     [axis[2], 0, -axis[0]],
+                     [-axis[1], axis[0], 0]])
+    return numpy.eye(3) + numpy.sin(angle) * K + (1 - numpy.cos(angle)) * K @ K
+
+
+def apply(transform: numpy.ndarray, points: numpy.ndarray) -> numpy.ndarray:
+    return points @ transform[:3, :3].T + transform[:3, 3]
+
+
+def icp(source: numpy.ndarray, target: numpy.ndarray, normals: numpy.ndarray,
+        tree: cKDTree, transform: numpy.ndarray, max_dist: float,
+        iterations: int=30, tolerance: float=1e-6):
+    '''
+    Point to plane ICP of source onto target (whose kd tree and normals are
+    given), starting from transform. Correspondences further than max_dist
+    apart are ignored. Returns the refined 4x4 transform and the rms error.
+    '''
+    transform = transform.copy()
+    rms = numpy.inf
+    for _ in range(iterations):
+        moved = apply(transform, source)
+        dist, idx = tree.query(moved, distance_upper_bound=max_dist)
+        found = numpy.isfinite(dist)
+        if numpy.count_nonzero(found) < 6:
+            break
+        p = moved[found]
+        q = target[idx[found]]
+        n = normals[idx[found]]
+        # linearized: minimize sum(((R p + t - q) . n)^2) for small R
+        A = numpy.hstack([numpy.cross(p, n), n])
+        b = numpy.einsum('ij,ij->i', q - p, n)
+        x, *_ = numpy.linalg.lstsq(A, b, rcond=None)
+        step = numpy.eye(4)
+        step[:3, :3] = rotation(*x[:3])
+        step[:3, 3] = x[3:]
+        transform = step @ transform
+        rms = numpy.sqrt(numpy.mean((A @ x - b) ** 2))
+        if numpy.abs(x).max() < tolerance:
+            break
+    return transform, rms
+
+
+def register(clouds, levels=(200, 80, 30), dedup: float=10):
+    '''
+    Align clouds into the frame of the first one. Returns the merged,
+    deduplicated cloud and the 4x4 transform of each cloud.
+    '''
+    transforms = [numpy.eye(4)]
+    merged = [clouds[0]]
+    for i, cloud in enumerate(clouds[1:], 1):
+        target_all = numpy.concatenate(merged)
+        transform = numpy.eye(4)
+        for voxel in levels:
+            target = voxel_downsample(target_all, voxel)
+            source = voxel_downsample(cloud, voxel)
+            tree = cKDTree(target)
+            normals = estimate_normals(target, tree)
+            transform, rms = icp(source, target, normals, tree, transform,
+                                 max_dist=3 * voxel)
+            print('scan {} voxel {}: rms {:.2f}'.format(i, voxel, rms))
+        transforms.append(transform)
+        # Dedup as we go so the target doesn't keep growing with overlap
+        merged = [voxel_downsample(
+            numpy.concatenate(merged + [apply(transform, cloud)]), dedup)]
+    return voxel_downsample(numpy.concatenate(merged), dedup), transforms
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Align and merge scans')
+    parser.add_argument('scans', nargs='+')
+    parser.add_argument('-o', '--output', default='merged.ply')
+    parser.add_argument('--levels', default='200,80,30',
+                        help='coarse to fine ICP voxel sizes in mm')
+    parser.add_argument('--dedup', type=float, default=10,
+                        help='merge points closer than this (mm)')
+    args = parser.parse_args()
+
+    clouds = [load_points(path) for path in args.scans]
+    levels = [float(level) for level in args.levels.split(',')]
+    merged, transforms = register(clouds, levels, args.dedup)
+    with open(args.output, 'wb') as f:
+        convert.write_ply(f, len(merged), [merged])
+    with open(args.output + '.transforms.json', 'w') as f:
+        json.dump({path: t.tolist() for path, t in zip(args.scans, transforms)},
+                  f, indent=2)
+    print('Wrote {} points to {}'.format(len(merged), args.output))
+
+
+if __name__ == '__main__':
+    main()
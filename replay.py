@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+
+# Hardware replay backend
+#
+# Stands in for the hokuyoaist library and the pigpio connection so the
+# scan pipeline can run (and be profiled) on any box:
+#
+#   rig = replay.ReplayRig('scan-1234.lscan', scan_period=0.1)
+#   l = scan.Lidar(backend=rig, pi=rig.pi)
+#
+# The sensor serves the recorded slice closest to where the servo currently
+# is, one slice per scan_period like the real thing. The servo takes
+# settle_time to reach a new position, a slice captured before that is
+# taken at the old position. Without a recorded scan, a box shaped room is
+# synthesized instead.
+
+import threading
+import time
+
+import numpy
+
+import scanfile
+from servo import Servo
+
+
+class ReplayPi:
+    '''Enough of pigpio.pi to drive servo.Servo'''
+
+    def __init__(self, settle_time: float=0.05, latency: float=0.0005):
+        # How long the servo takes to get where it was told to go
+        self.settle_time = settle_time
+        # Round trip to the pigpio daemon
+        self.latency = latency
+        self._lock = threading.Lock()
+        self._pw = {}
+        self._prev_pw = {}
+        self._set_at = {}
+
+    def set_mode(self, pin: int, mode: int) -> None:
+        pass
+
+    def set_servo_pulsewidth(self, pin: int, pw: float) -> None:
+        time.sleep(self.latency)
+        with self._lock:
+            self._prev_pw[pin] = self.position(pin)
+            self._pw[pin] = pw
+            self._set_at[pin] = time.time()
+
+    def get_servo_pulsewidth(self, pin: int) -> float:
+        return self._pw.get(pin, 0)
+
+    def position(self, pin: int) -> float:
+        '''Pulse width the servo is physically at right now'''
+        if pin not in self._pw:
+            return 0
+        if time.time() - self._set_at[pin] < self.settle_time:
+            return self._prev_pw[pin]
+        return self._pw[pin]
+
+
+class ScanData:
+    '''hokuyoaist.ScanData lookalike'''
+
+    def __init__(self):
+        self.ranges = numpy.empty(0, dtype=numpy.uint16)
+
+    def ranges_length(self) -> int:
+        return len(self.ranges)
+
+    def range(self, idx: int) -> int:
+        return int(self.ranges[idx])
+
+    def clean_up(self) -> None:
+        self.ranges = numpy.empty(0, dtype=numpy.uint16)
+
+
+class Sensor:
+    '''hokuyoaist.Sensor lookalike, serves slices from a ReplayRig'''
+
+    def __init__(self, rig):
+        self.rig = rig
+        self.is_open = False
+        self._next_scan = 0
+
+    def open(self, port_opts: str) -> None:
+        time.sleep(self.rig.open_time)
+        self.is_open = True
+        self._next_scan = time.time()
+
+    def close(self) -> None:
+        self.is_open = False
+
+    def set_power(self, on: bool) -> None:
+        pass
+
+    def step_to_angle(self, steps: int) -> float:
+        return numpy.radians(steps * self.rig.step_arc)
+
+    def get_new_ranges(self, data: ScanData, *args) -> int:
+        '''Wait for the next full scan, like the sensor does'''
+        if not self.is_open:
+            raise RuntimeError('Sensor is not open')
+        now = time.time()
+        if now < self._next_scan:
+            time.sleep(self._next_scan - now)
+        self._next_scan = max(now, self._next_scan) + self.rig.scan_period
+        # The scan happens over the scan period, report where the servo
+        # was at the end of it
+        data.ranges = self.rig.slice_at(
+            Servo.pw_to_deg(self.rig.pi.position(Servo.PIN)))
+        return len(data.ranges)
+
+
+class ReplayRig:
+    '''
+    A replay sensor and servo sharing one timeline. Pass it as the Lidar
+    backend, and rig.pi as its pi.
+
+    path is a recorded scan file, or None for a synthetic box room of
+    room_size mm. scan_period is the time per sensor scan, open_time the
+    time to open the port, settle_time the time the servo takes to move.
+    '''
+    ScanData = ScanData
+
+    def __init__(self, path: str=None, scan_period: float=0.1,
+                 settle_time: float=0.05, open_time: float=0.2,
+                 room_size=(4000, 3000, 2500), n_steps: int=683):
+        self.scan_period = scan_period
+        self.open_time = open_time
+        self.pi = ReplayPi(settle_time)
+        if path:
+            scan = scanfile.ScanFile(path)
+            self.step_arc = scan.theta_step
+            self.phi = numpy.asarray(scan.phi)
+            self.ranges = numpy.asarray(scan.ranges)
+        else:
+            self.step_arc = 360 / 1024
+            self.phi = numpy.arange(0, 90, dtype=numpy.float64)
+            self.ranges = self._box_room(numpy.asarray(room_size), n_steps)
+
+    def _box_room(self, size: numpy.ndarray, n_steps: int) -> numpy.ndarray:
+        '''Ranges from the middle of a box shaped room'''
+        theta = numpy.radians(numpy.arange(n_steps) * self.step_arc)
+        phi = numpy.radians(self.phi)[:, None]
+        direction = numpy.stack([
+            numpy.sin(phi) * numpy.cos(theta),
+            numpy.sin(phi) * numpy.sin(theta),
+            numpy.cos(phi) * numpy.ones_like(theta)])
+        with numpy.errstate(divide='ignore'):
+            to_wall = (size / 2)[:, None, None] / numpy.abs(direction)
+        ranges = to_wall.min(axis=0)
+        return numpy.clip(ranges, 0, scanfile.MAX_RANGE).astype(numpy.uint16)
+
+    def Sensor(self) -> Sensor:
+        return Sensor(self)
+
+    def slice_at(self, phi: float) -> numpy.ndarray:
+        '''Recorded slice closest to phi'''
+        return self.ranges[numpy.abs(self.phi - phi).argmin()]
@@ -1,15 +1,23 @@
 #!/usr/bin/env python3
 
 # Inits hardware PWM server and begins laser scan
+# Set ROLLING_METRICS=<path> to also stream per slice metrics to a file
 
+import os
 import scan
 import servo
 import time
+import instrumentation
 
 with servo.Pigpiod() as daemon:
     print('Awaiting pigiod init...')
     time.sleep(1)
-    l = scan.Lidar()
-    l.scan()
+    metrics = instrumentation.SweepMetrics(
+        rolling_path=os.getenv('ROLLING_METRICS'))
+    l = scan.Lidar(metrics=metrics)
+    try:
+        l.scan(pipelined=True)
+    finally:
+        l.close()
 
 print('Done')
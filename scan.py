@@ -4,66 +4,254 @@
 
 import time
 import math
-import pickle
 import os
 import logging
+import queue
+import threading
 
+import numpy
+import controller
+import convert
+import instrumentation
+import preview
+import scanfile
 import servo
-from typing import List
 
-# Load .so for correct arch
-if os.uname().machine == 'x86_64':
-    import amd64.hokuyoaist as lidar
-else:
-    import arm.hokuyoaist as lidar
+
+def hokuyo_backend():
+    '''Load the hokuyoaist .so for the correct arch'''
+    if os.uname().machine == 'x86_64':
+        import amd64.hokuyoaist as lidar
+    else:
+        import arm.hokuyoaist as lidar
+    return lidar
+
+
+class SensorSession:
+    '''
+    Long lived connection to the rangefinder. The port is opened once, and a
+    background producer thread keeps pulling fresh slices off it into a
+    bounded queue. Consumers ask for a slice captured after a given time
+    (ie. after the servo was moved) instead of reopening the port each time.
+    '''
+
+    def __init__(self, port_opts: str, queue_len: int=2, backend=None):
+        '''
+        backend is anything with hokuyoaist style Sensor and ScanData
+        constructors, by default the real hokuyoaist library
+        '''
+        self.port_opts = port_opts
+        self.backend = backend or hokuyo_backend()
+        self.slices = queue.Queue(maxsize=queue_len)
+        self.sensor = None
+        self._thread = None
+        self._stop = threading.Event()
+
+    def open(self) -> None:
+        '''Open the port and turn on the laser'''
+        self.sensor = self.backend.Sensor()
+        self.sensor.open(self.port_opts)
+        self.sensor.set_power(True)
+        logging.info('Opened sensor session on %s', self.port_opts)
+
+    def start(self) -> None:
+        '''Start continuous capture on the producer thread'''
+        if self._thread:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._produce, daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        '''Stop continuous capture, the port stays open'''
+        if not self._thread:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    def close(self) -> None:
+        self.stop()
+        if self.sensor:
+            self.sensor.close()
+            self.sensor = None
+            logging.info('Closed sensor session')
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _produce(self) -> None:
+        '''
+        Producer loop, runs until stop() is called. Each queue item is a
+        (capture start time, ranges) pair. If the consumer falls behind the
+        oldest slice is dropped, we only ever want fresh data.
+        '''
+        while not self._stop.is_set():
+            r_values = self.backend.ScanData()
+            stamp = time.time()
+            try:
+                self.sensor.get_new_ranges(r_values)
+                n = r_values.ranges_length()
+                ranges = numpy.fromiter(
+                    map(r_values.range, range(n)), dtype=numpy.uint32, count=n)
+            except Exception:
+                logging.exception('Range capture failed')
+                # don't spin on a dead port
+                time.sleep(0.1)
+                continue
+            finally:
+                r_values.clean_up()
+
+            while True:
+                try:
+                    self.slices.put_nowait((stamp, ranges))
+                    break
+                except queue.Full:
+                    try:
+                        self.slices.get_nowait()
+                    except queue.Empty:
+                        pass
+
+    def get_slice(self, since: float=0, timeout: float=5) -> numpy.ndarray:
+        '''
+        Return the ranges of the first slice whose capture started at or
+        after since. Older (stale) slices are discarded.
+        '''
+        deadline = time.time() + timeout
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise TimeoutError('No slice from sensor in {}s'.format(timeout))
+            try:
+                stamp, ranges = self.slices.get(timeout=remaining)
+            except queue.Empty:
+                continue
+            if stamp >= since:
+                return ranges
 
 
 class Lidar:
 
-    DATA_PATH = '/etc/data/scans'
-    # cartesian coordinates
-    scan_data = []
+    DATA_PATH = scanfile.DATA_PATH
     port_opts = 'type=serial,device=/dev/ttyACM0,timeout=1'
+    # according to docs:
+    # 683 steps
+    # scan ccw from top
+    STEP_ARC_DEG = 360 / 1024 # in deg, from spec sheet
+    # r less than 20mm means the sample is bad
+    MIN_RANGE = 20
+    # turns out the maximum angle is 89.xxx
+    MAX_PHI = 89
+    # time of the last servo move, slices captured before this are stale
+    moved_at = 0
 
     def sys_init(self) -> None:
         '''
-        Lidar system init
+        Lidar system init, opens the sensor session used for every sweep
         '''
-        try:
-            sensor = lidar.Sensor()
-            sensor.open(self.port_opts)
-            self.STEP_SIZE_DEG = sensor.step_to_angle(1)
-        finally:
-            sensor.close()
+        self.session = SensorSession(self.port_opts, backend=self.backend)
+        with self.metrics.timed_session('port_open'):
+            self.session.open()
+        self.STEP_SIZE_DEG = self.session.sensor.step_to_angle(1)
 
-    def __init__(self):
+    def __init__(self, metrics=None, backend=None, pi=None, voxel_filter=None,
+                 settle_time=None):
+        '''
+        metrics is an instrumentation.SweepMetrics to record per slice
+        timings in, by default nothing is recorded. backend and pi swap out
+        the hokuyoaist library and pigpio connection, see replay.py.
+        voxel_filter is an optional voxelfilter.VoxelFilter every slice is
+        fed through, its output is saved next to the scan. settle_time is
+        how long to wait after a servo move, a controller.SettleTime by
+        default.
+        '''
         logging.basicConfig(level=logging.DEBUG)
+        self.backend = backend
+        self.settle_time = settle_time or controller.SettleTime()
+        self.voxel_filter = voxel_filter
+        self.metrics = metrics or instrumentation.NullMetrics()
+        # cartesian coordinates, preallocated for the whole sweep
+        # only the first n_points rows are valid
+        self.scan_data = numpy.empty((0, 3))
+        self.n_points = 0
+        self.sweep_slices = 1
+        # theta sin/cos tables, built once we know how many steps a slice has
+        self.theta_sin = self.theta_cos = numpy.empty(0)
         self.ensure_writable()
-        self.servo = servo.Servo()
+        self.servo = servo.Servo(pi=pi)
         self.sys_init()
 
+    def close(self) -> None:
+        '''Release the sensor session'''
+        self.session.close()
+
     def ensure_writable(self) -> None:
         '''Make sure there's a place for the data to go'''
         os.makedirs(self.DATA_PATH, exist_ok=True)
         os.access(self.DATA_PATH, os.W_OK | os.X_OK)
         logging.info('Verified scan write permissions')
 
-    def scan(self) -> None:
+    def scan(self, pipelined: bool=False, stepper=None, draw_preview: bool=True) -> None:
         '''
         Scan ~170 degrees in rho axis, taking a 140 deg horizontal 
-        scan for each rho slice
+        scan for each rho slice. If pipelined, servo moves overlap with
+        slice processing, see controller.ScanController. If a stepper
+        (adaptive.AdaptiveStepper) is given it picks the phi step after
+        each slice, otherwise the step is always one degree.
         '''
-        # turns out the maximum angle is 89.xxx
-        while(self.servo.phase_angle < 89):
-                logging.info(
-                    'Scanning horizon at phi: {:.2f} deg'.format(self.servo.phase_angle))
-                self.scan_horizon(self.servo.phase_angle)
-                self.servo.increment()
+        self.n_points = 0
+        self.sweep_slices = math.ceil(self.MAX_PHI - self.servo.phase_angle)
+        self.open_scan_file()
+        self.metrics.reset()
+        if self.voxel_filter:
+            self.voxel_filter.reset()
+        if stepper:
+            stepper.reset()
+        # One open port and continuous capture for the whole sweep
+        self.session.start()
+        try:
+            if pipelined:
+                controller.ScanController(self, stepper=stepper).run()
+            else:
+                while(self.servo.phase_angle < self.MAX_PHI):
+                        phi = self.servo.phase_angle
+                        logging.info(
+                            'Scanning horizon at phi: {:.2f} deg'.format(phi))
+                        idx = self.metrics.begin_slice(phi)
+                        with self.metrics.timed(idx, 'acquire'):
+                            ranges = self.session.get_slice(since=self.moved_at)
+                        self.process_slice(ranges, phi, idx)
+                        step = stepper.next_step(ranges, phi) if stepper else 1
+                        with self.metrics.timed(idx, 'move'):
+                            self.servo.increment(step)
+                        with self.metrics.timed(idx, 'settle'):
+                            time.sleep(self.settle_time(step))
+                        # Anything captured before this point was taken mid move
+                        self.moved_at = time.time()
+                        self.metrics.end_slice(idx)
+        except BaseException:
+            # Keep whatever slices made it, an empty file is removed
+            self.writer.close()
+            raise
+        finally:
+            self.session.stop()
 
         self.write()
-        self.draw_pointmap(self.scan_data)
+        if draw_preview:
+            # Renders off a decimated copy in the background, so it never
+            # holds up the next sweep
+            self.preview = preview.start(self.scan_path)
         self.servo.reset_pos()
 
+    @property
+    def points(self) -> numpy.ndarray:
+        '''Cartesian points captured so far this sweep'''
+        return self.scan_data[:self.n_points]
+
     def to_cartesian(self, r: float, theta_deg: float, phi_deg: float) -> (float, float, float):
         '''
         Convert sphereical deg to cartesian coords
@@ -77,70 +265,106 @@ class Lidar:
         z = r * math.cos(phi)
         return (x, y, z)
 
-    def scan_horizon(self, phi: float) -> List:
+    def build_theta_tables(self, n_steps: int) -> None:
+        '''
+        Precompute sin/cos of theta for every step in a slice, theta only
+        depends on the step index so this only has to happen once
+        '''
+        theta = numpy.radians(numpy.arange(n_steps) * self.STEP_ARC_DEG)
+        self.theta_sin = numpy.sin(theta)
+        self.theta_cos = numpy.cos(theta)
+
+    def slice_to_cartesian(self, ranges: numpy.ndarray, phi_deg: float) -> numpy.ndarray:
+        '''
+        Batch version of to_cartesian for a whole slice. Bad samples are
+        masked out, returns an (n, 3) array of the good ones.
+        '''
+        if len(ranges) != len(self.theta_sin):
+            self.build_theta_tables(len(ranges))
+        # phi is fixed for the slice, so it is only a scalar
+        return scanfile.slice_to_cartesian(
+            ranges, phi_deg, self.theta_sin, self.theta_cos, self.MIN_RANGE)
+
+    def reserve(self, n: int) -> None:
+        '''Make sure there is space for n more points in scan_data'''
+        needed = self.n_points + n
+        if needed <= len(self.scan_data):
+            return
+        # first slice of a sweep, size for the full sweep
+        size = max(needed, self.sweep_slices * n, 2 * len(self.scan_data))
+        grown = numpy.empty((size, 3))
+        grown[:self.n_points] = self.points
+        self.scan_data = grown
+
+    def scan_horizon(self, phi: float) -> numpy.ndarray:
         '''
         Scans from theta_0 to theta_1 in rad, then saves the resulting data in
         cartesian form. The hardware is limited to arcs of < 2 rad. This will only scan
         dZ in the XY plane.
         '''
-        # according to docs:
-        # 683 steps
-        # scan ccw from top
-        step_arc = 360 / 1024 # in deg, from spec sheet
-        sensor = lidar.Sensor()
-        r_values = lidar.ScanData()
-        try:
-            sensor.open(self.port_opts)
-            num_samples = sensor.get_new_ranges(r_values)
-        finally:
-            sensor.close()
-
-        for idx in range(r_values.ranges_length()):
-            # Angular resolution per sample
-            theta = idx * step_arc
-            r = r_values.range(idx)
-            # r less than 20mm means the sample is bad
-            if r <= 20:
-                logging.info(
-                    'Got bad r at theta: {:.2f} phi: {:.2f}'.format(theta, phi))
-                continue
-            x, y, z = self.to_cartesian(r, theta, phi)
-            # Save data for writing
-            self.scan_data.append((x, y, z))
-        
-        r_values.clean_up()
-        return self.scan_data
+        idx = self.metrics.begin_slice(phi)
+        with self.metrics.timed(idx, 'acquire'):
+            ranges = self.session.get_slice(since=self.moved_at)
+        points = self.process_slice(ranges, phi, idx)
+        self.metrics.end_slice(idx)
+        return points
+
+    def process_slice(self, ranges: numpy.ndarray, phi: float, idx: int=None) -> numpy.ndarray:
+        '''
+        Persist a slice of raw ranges taken at phi, and add its cartesian
+        coords to scan_data. Returns the coords of the slice. idx is the
+        metrics record of the slice.
+        '''
+        # Persist raw ranges first, so a crash keeps this slice
+        with self.metrics.timed(idx, 'write'):
+            self.writer.append(ranges, phi)
+        with self.metrics.timed(idx, 'convert'):
+            self.reserve(len(ranges))
+            points = self.slice_to_cartesian(ranges, phi)
+        if self.voxel_filter:
+            with self.metrics.timed(idx, 'filter'):
+                self.voxel_filter.add(points)
+        self.metrics.count(idx, 'points', len(points))
+        self.metrics.count(idx, 'bad_samples', len(ranges) - len(points))
+        # Save data for writing
+        self.scan_data[self.n_points:self.n_points + len(points)] = points
+        self.n_points += len(points)
+        return points
+
+    def open_scan_file(self) -> None:
+        '''
+        Start a new scan file, slices are appended to it as they come in
+        '''
+        fname = 'scan-%d' % time.time() + scanfile.EXTENSION
+        self.scan_path = self.DATA_PATH + '/' + fname
+        logging.info('Writing scan to %s...', self.scan_path)
+        self.writer = scanfile.ScanWriter(
+            self.scan_path,
+            theta_step=self.STEP_ARC_DEG,
+            phi0=self.servo.phase_angle,
+            min_range=self.MIN_RANGE)
 
     def write(self) -> None:
         '''
-        Write pickled scan data to file
-        '''
-        fname = 'scan-%d' % time.time()
-        fpath = self.DATA_PATH + '/' + fname
-        logging.info('Writing scan to %s...', fpath)
-        with open(fpath, 'wb') as f:
-            pickle.dump(self.scan_data, f)
-
-    def draw_pointmap(self, data):
-        '''
-        Debug graphing
-        '''
-        import matplotlib
-        matplotlib.use('Agg')
-        import matplotlib.pyplot as plt
-        from mpl_toolkits.mplot3d import Axes3D
-        plt.ioff()
-        fig = plt.figure()
-        ax = fig.add_subplot(111, projection='3d')
-        ax.set_xlabel('X in mm')
-        ax.set_ylabel('Y in mm')
-        ax.set_zlabel('Z in mm')
-
-        x = [a[0] for a in data]
-        y = [a[1] for a in data]
-        z = [a[2] for a in data]
-        # draw our position
-        ax.scatter([0], [0], [0], c='b', marker='^')
-        ax.scatter(x, y, z, c='r', marker='.')
-        
-        plt.savefig('figure')
+        Finish writing the scan file
+        '''
+        self.writer.close()
+        logging.info('Wrote {} slices to {}'.format(
+            self.writer.n_slices, self.scan_path))
+        if self.voxel_filter:
+            self.write_filtered()
+        summary = self.metrics.write_summary(self.scan_path + '.metrics.json')
+        if summary:
+            logging.info('Sweep took {:.2f}s, {:.2f} slices/s, {} bad samples'.format(
+                summary['duration'], summary['slices_per_sec'],
+                summary['bad_samples']))
+
+    def write_filtered(self) -> None:
+        '''Save the voxel filtered cloud as a .ply next to the scan'''
+        points = self.voxel_filter.points()
+        path = self.scan_path + '.filtered.ply'
+        with open(path, 'wb') as f:
+            convert.write_ply(f, len(points), [points])
+        stats = self.voxel_filter.stats()
+        logging.info('Voxel filter kept {} of {} points ({:.1%} reduction), wrote {}'.format(
+            stats['points_out'], stats['points_in'], stats['reduction'], path))
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+
+# Compact on-disk scan format
+#
+# A scan file is a fixed header followed by one row per slice. Each row is
+# the servo step index of the slice followed by the raw ranges of the slice
+# as uint16 millimetres. theta and phi are never stored, they are implicit
+# from the sensor/servo geometry in the header:
+#
+#   theta = theta0 + step * theta_step
+#   phi = phi0 + index * phi_step
+#
+# Rows are appended as the scan runs, so a crash mid sweep only loses the
+# slice that was being written.
+
+import os
+import struct
+import time
+
+import numpy
+
+# Where the scanner puts its scans
+DATA_PATH = '/etc/data/scans'
+MAGIC = b'LSCN'
+VERSION = 1
+EXTENSION = '.lscan'
+# magic, version, header size, steps per slice, min valid range, reserved,
+# theta0, theta step, phi0, phi step (all deg), creation time
+HEADER = struct.Struct('<4sHHIHHddddd')
+# Largest range we can store
+MAX_RANGE = numpy.iinfo(numpy.uint16).max
+
+
+def row_dtype(n_steps: int) -> numpy.dtype:
+    '''numpy dtype of a single slice row'''
+    return numpy.dtype([('index', '<u2'), ('ranges', '<u2', (n_steps,))])
+
+
+def slice_to_cartesian(ranges, phi_deg, theta_sin, theta_cos, min_range=20):
+    '''
+    Convert raw ranges to cartesian coords. ranges is either one slice
+    (phi_deg is a scalar) or a block of slices (phi_deg has one entry per
+    slice). Bad samples are masked out, returns an (n, 3) array.
+    '''
+    ranges = numpy.asarray(ranges)
+    phi = numpy.radians(numpy.asarray(phi_deg, dtype=numpy.float64))
+    if ranges.ndim == 2:
+        phi = phi[:, None]
+    good = ranges > min_range
+    r = ranges.astype(numpy.float64)
+    # xy plane is the floor
+    # z plane going up
+    # phi is the angle from the Z-axis to vector r
+    r_xy = r * numpy.sin(phi)
+    points = numpy.empty((numpy.count_nonzero(good), 3))
+    points[:, 0] = (r_xy * theta_cos)[good]
+    points[:, 1] = (r_xy * theta_sin)[good]
+    points[:, 2] = (r * numpy.cos(phi))[good]
+    return points
+
+
+class ScanWriter:
+    '''
+    Appends slices to a scan file. The header is written along with the first
+    slice, since that's when we find out how many steps a slice has. If the
+    writer is closed before any slice came in, the empty file is removed.
+    '''
+
+    def __init__(self, path: str, theta_step: float, phi0: float,
+                 phi_step: float=1, theta0: float=0, min_range: int=20,
+                 sync: bool=True):
+        self.path = path
+        self.theta0 = theta0
+        self.theta_step = theta_step
+        self.phi0 = phi0
+        self.phi_step = phi_step
+        self.min_range = min_range
+        # fsync each slice so a power cut doesn't lose the page cache
+        self.sync = sync
+        self.n_steps = None
+        self.n_slices = 0
+        self.f = open(path, 'wb')
+
+    def _write_header(self, n_steps: int) -> None:
+        self.n_steps = n_steps
+        self.dtype = row_dtype(n_steps)
+        self.f.write(HEADER.pack(
+            MAGIC, VERSION, HEADER.size, n_steps, self.min_range, 0,
+            self.theta0, self.theta_step, self.phi0, self.phi_step,
+            time.time()))
+
+    def append(self, ranges, phi: float) -> None:
+        '''Append one slice of raw ranges (mm) taken at phi deg'''
+        if self.n_steps is None:
+            self._write_header(len(ranges))
+        if len(ranges) != self.n_steps:
+            raise ValueError('Slice has {} steps, expected {}'.format(
+                len(ranges), self.n_steps))
+        row = numpy.empty(1, dtype=self.dtype)
+        row['index'] = round((phi - self.phi0) / self.phi_step)
+        row['ranges'] = numpy.clip(ranges, 0, MAX_RANGE)
+        self.f.write(row.tobytes())
+        self.f.flush()
+        if self.sync:
+            os.fsync(self.f.fileno())
+        self.n_slices += 1
+
+    def close(self) -> None:
+        if not self.f.closed:
+            self.f.close()
+            # No header without a slice, don't leave an unreadable file around
+            if self.n_steps is None:
+                os.unlink(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class ScanFile:
+    '''
+    Read only view of a scan file. ranges is a zero copy memmap of the raw
+    data, cartesian coords are only computed when asked for.
+    '''
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, 'rb') as f:
+            header = f.read(HEADER.size)
+        if len(header) < HEADER.size or header[:4] != MAGIC:
+            raise ValueError('{} is not a scan file'.format(path))
+        (_, self.version, header_size, self.n_steps, self.min_range, _,
+         self.theta0, self.theta_step, self.phi0, self.phi_step,
+         self.timestamp) = HEADER.unpack(header)
+        if self.version > VERSION:
+            raise ValueError('{} has unsupported version {}'.format(
+                path, self.version))
+
+        dtype = row_dtype(self.n_steps)
+        # Ignore a partially written trailing row
+        n_slices = (os.path.getsize(path) - header_size) // dtype.itemsize
+        if n_slices:
+            self.rows = numpy.memmap(path, dtype=dtype, mode='r',
+                                     offset=header_size, shape=(n_slices,))
+        else:
+            self.rows = numpy.empty(0, dtype=dtype)
+
+        theta = numpy.radians(self.theta)
+        self.theta_sin = numpy.sin(theta)
+        self.theta_cos = numpy.cos(theta)
+
+    @staticmethod
+    def is_scan_file(path: str) -> bool:
+        with open(path, 'rb') as f:
+            return f.read(len(MAGIC)) == MAGIC
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    @property
+    def ranges(self) -> numpy.ndarray:
+        '''(slices, steps) raw ranges in mm'''
+        return self.rows['ranges']
+
+    @property
+    def theta(self) -> numpy.ndarray:
+        '''theta of each step in deg'''
+        return self.theta0 + numpy.arange(self.n_steps) * self.theta_step
+
+    @property
+    def phi(self) -> numpy.ndarray:
+        '''phi of each slice in deg'''
+        return self.phi0 + self.rows['index'] * self.phi_step
+
+    @property
+    def valid(self) -> numpy.ndarray:
+        '''Mask of good samples'''
+        return self.ranges > self.min_range
+
+    def count(self) -> int:
+        '''Number of good samples'''
+        return int(numpy.count_nonzero(self.valid))
+
+    def iter_points(self, chunk: int=32):
+        '''Yield cartesian coords, chunk slices at a time'''
+        phi = self.phi
+        for start in range(0, len(self), chunk):
+            yield slice_to_cartesian(
+                self.ranges[start:start + chunk], phi[start:start + chunk],
+                self.theta_sin, self.theta_cos, self.min_range)
+
+    def points(self) -> numpy.ndarray:
+        '''Cartesian coords of every good sample'''
+        if not len(self):
+            return numpy.empty((0, 3))
+        return numpy.concatenate(list(self.iter_points()))
@@ -7,7 +7,14 @@ import math
 import time
 import subprocess
 from contextlib import contextmanager
-import pigpio
+
+# pigpio is only needed when talking to the real servo
+try:
+    import pigpio
+    OUTPUT = pigpio.OUTPUT
+except ImportError:
+    pigpio = None
+    OUTPUT = 1
 
 
 class Pigpiod:
@@ -44,9 +51,10 @@ class Servo:
     def pulse_width(self, pw: int) -> None:
         self.p.set_servo_pulsewidth(self.PIN, pw)
 
-    def __init__(self, debug=False):
+    def __init__(self, debug=False, pi=None):
         '''
-        Initialize servo hardware
+        Initialize servo hardware. pi is the pigpio connection, anything with
+        the same servo methods works (see replay.ReplayPi)
         '''
         if debug:
                 logging.basicConfig(level=logging.DEBUG)
@@ -59,25 +67,28 @@ class Servo:
                 except:
                     pass
 
-        self.p = pigpio.pi()
-        self.p.set_mode(self.PIN, pigpio.OUTPUT) 
+        self.p = pi or pigpio.pi()
+        self.p.set_mode(self.PIN, OUTPUT)
         self.pulse_width = self.NEUTRAL
         self.p.set_servo_pulsewidth(self.PIN, self.pulse_width)
 
-    def pw_to_deg(self, pw) -> float:
+    @classmethod
+    def pw_to_deg(cls, pw) -> float:
         '''
         Converts pulse width to a degree
 
         By default, 180 deg is parallel to the ground and 90 deg is straight up.
         Subtract 90 so our spherical to cartesian conversion is easier later.
         ''' 
-        return (pw - self.MIN) / self.STEPS_DEG - 90
+        return (pw - cls.MIN) / cls.STEPS_DEG - 90
 
     def increment(self, steps: int=1) -> float:
         '''
-        Increment pulse_width by STEPS_DEG, returns angle (90 deg is neutral)
+        Increment pulse_width by STEPS_DEG, returns angle (90 deg is neutral).
+        Stops at MIN/MAX, pigpio won't take a pulse width outside them.
         '''
-        self.pulse_width += steps * self.STEPS_DEG
+        pw = self.pulse_width + steps * self.STEPS_DEG
+        self.pulse_width = min(max(pw, self.MIN), self.MAX)
         logging.debug(
                 'Increased pulse width to {}'.format(self.pulse_width))
                         
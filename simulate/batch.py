@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+
+# Run a batch of multi bot scenarios against the handholds of one mesh
+#
+#   TEST=true ./batch.py scenarios.json -o results.csv -j 4
+#
+# The mesh is picked the same way as simulate.py (TEST, ITOKAWA). The
+# scenario file is a JSON list of scenarios like
+#
+#   {"name": "planar-4", "start": [[x, y, z], ...], "goal": [x, y, z],
+#    "bots": 4, "hop_distance": 100, "tether_distance": 250,
+#    "planner": "field", "max_turns": 1000}
+#
+# Only start and goal are needed. bots takes the first that many start
+# positions. hop_distance can't be over simulate.MAX_HOP_DISTANCE, the
+# handholds don't have any longer edges. The handholds are loaded once,
+# before the workers are forked, so they all share the same read only
+# graph. Results go to a CSV, one row per scenario in the same order as
+# the file.
+
+import argparse
+import csv
+import json
+import multiprocessing
+import os
+
+import simulate
+
+FIELDS = ['name', 'planner', 'bots', 'hop_distance', 'tether_distance',
+          'success', 'turns', 'total_dist', 'runtime', 'error']
+
+# Handhold graph, shared with the workers
+_h = None
+
+
+def _init():
+    global _h
+    # Already there if the workers were forked
+    if _h is None:
+        _h = simulate.load_handholds()
+
+
+def run(scenario: dict) -> dict:
+    '''Run one scenario, returns its row of results'''
+    start = scenario['start'][:scenario.get('bots', len(scenario['start']))]
+    params = {
+        'planner': scenario.get('planner', simulate.PLANNER),
+        'hop_distance': scenario.get('hop_distance', simulate.MAX_HOP_DISTANCE),
+        'tether_distance': scenario.get('tether_distance', simulate.TETHER_DISTANCE),
+    }
+    row = dict(params, name=scenario.get('name', ''), bots=len(start))
+    try:
+        _, result = simulate.run_scenario(
+            _h, start, scenario['goal'], max_turns=scenario.get('max_turns', 1000),
+            verbose=False, **params)
+    except Exception as e:
+        # Couldn't even start, e.g. a position that isn't a handhold
+        result = {'success': False, 'turns': 0, 'total_dist': 0, 'runtime': 0,
+                  'error': str(e)}
+    row.update(result)
+    return row
+
+
+def main():
+    global _h
+    parser = argparse.ArgumentParser(description='Run a batch of scenarios')
+    parser.add_argument('scenarios', help='JSON list of scenarios')
+    parser.add_argument('-o', '--output', default='results.csv')
+    parser.add_argument('-j', '--processes', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    with open(args.scenarios) as f:
+        scenarios = json.load(f)
+    print('Loading handholds...')
+    _h = simulate.load_handholds(simulate.REGEN_HOLDS, simulate.REGEN_GRAPH)
+    # Build anything the planners cache up front, rather than in every
+    # worker at once
+    goal = next(iter(_h.g.nodes))
+    for planner in set(s.get('planner', simulate.PLANNER) for s in scenarios):
+        try:
+            simulate.make_planner(planner, _h, goal)
+        except ValueError as e:
+            # Only fails the scenarios using it, run() records the error
+            print('Skipping warm up of planner {}: {}'.format(planner, e))
+
+    with open(args.output, 'w', newline='') as f:
+        writer = csv.DictWriter(f, FIELDS)
+        writer.writeheader()
+        with multiprocessing.Pool(args.processes, _init) as p:
+            for i, row in enumerate(p.imap(run, scenarios), 1):
+                writer.writerow(row)
+                f.flush()
+                print('{}/{} {}: {}'.format(
+                    i, len(scenarios), row['name'],
+                    'ok' if row['success'] else row['error']))
+    print('Wrote {}'.format(args.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+# Content addressed on disk cache for graph and handhold artifacts
+#
+# Artifacts are stored as plain .npy arrays under a directory named after a
+# hash of everything that went into them: the mesh file contents, the
+# parameters used, and the source of the code that computed them. Change
+# any of those and the key changes, so stale results are never loaded.
+# Arrays are loaded with mmap, so a cache hit costs next to nothing.
+#
+# <DATA_DIR>/cache/<key>/meta.json
+# <DATA_DIR>/cache/<key>/<name>.npy
+
+import hashlib
+import inspect
+import json
+import os
+import shutil
+import tempfile
+
+import numpy
+
+# Bump if the layout of cached artifacts changes
+FORMAT_VERSION = 1
+
+
+def file_digest(path: str) -> str:
+    '''sha256 of a file's contents'''
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def code_digest(*modules) -> str:
+    '''sha256 of the source of the given modules'''
+    h = hashlib.sha256()
+    for module in modules:
+        with open(inspect.getsourcefile(module), 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+class Cache:
+    def __init__(self, root: str):
+        self.root = root
+        # hashing a big mesh isn't free, only do it once per path
+        self._digests = {}
+
+    def key(self, mesh_path: str, params: dict, modules=()) -> str:
+        '''Cache key for artifacts computed from mesh_path with params by modules'''
+        mesh_path = os.path.realpath(mesh_path)
+        if mesh_path not in self._digests:
+            self._digests[mesh_path] = file_digest(mesh_path)
+        h = hashlib.sha256()
+        h.update(json.dumps({
+            'format': FORMAT_VERSION,
+            'mesh': self._digests[mesh_path],
+            'params': params,
+            'code': code_digest(*modules),
+        }, sort_keys=True).encode())
+        return h.hexdigest()[:32]
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.root, key)
+
+    def load(self, key: str):
+        '''Dict of memmapped arrays for key, or None on a miss'''
+        path = self.path(key)
+        try:
+            with open(os.path.join(path, 'meta.json')) as f:
+                meta = json.load(f)
+        except FileNotFoundError:
+            return None
+        return {name: numpy.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+                for name in meta['arrays']}
+
+    def save(self, key: str, meta: dict=None, **arrays) -> None:
+        '''Store arrays under key. Written to a temp dir and renamed into place.'''
+        os.makedirs(self.root, exist_ok=True)
+        tmp = tempfile.mkdtemp(dir=self.root, prefix='.tmp-')
+        try:
+            for name, array in arrays.items():
+                numpy.save(os.path.join(tmp, name + '.npy'),
+                           numpy.ascontiguousarray(array))
+            with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+                json.dump(dict(meta or {}, arrays=sorted(arrays)), f, indent=2)
+            shutil.rmtree(self.path(key), ignore_errors=True)
+            os.rename(tmp, self.path(key))
+        except BaseException:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
@@ -1,7 +1,11 @@
 from heapq import heappush, heappop
 from itertools import count
+import math
 from networkx import NetworkXError
 import networkx as nx
+import numpy
+from scipy.sparse import bmat, csr_matrix
+from scipy.sparse.csgraph import breadth_first_order, dijkstra
 
 from graph_utils import euclidean_distance, euclidean_distance_c
 
@@ -17,6 +21,17 @@ def compute_hub_pos(bots):
     return (sum(x) / len(x), sum(y) / len(y), sum(z) / len(z)) 
 
 
+def can_hop(bot, node, bots=[]) -> bool:
+    '''
+    Whether bot may move onto node: nobody is on it and it keeps bot in
+    tether range of the hub of the other bots
+    '''
+    if node.occupied:
+        return False
+    return not bots or euclidean_distance_c(
+        node, compute_hub_pos(bots)) <= bot.tether_distance
+
+
 def bounded_leg_astar(G,
                       source,
                       target,
@@ -115,3 +130,285 @@ def bounded_leg_astar(G,
             first_run = False
 
     raise nx.NetworkXNoPath("Node %s not reachable from %s" % (source, target))
+
+
+class CostToGo:
+    '''
+    Cost of the cheapest path to goal from every node, from one reverse
+    Dijkstra over the edges a bot can hop. All bots heading to the same
+    goal share it, so a move is a lookup over a bot's neighbours instead
+    of a fresh A* per bot per turn.
+
+    Nodes other bots sit on are repaired around locally: only nodes whose
+    cheapest path runs through a blocked node can get more expensive, so
+    just those are settled again, starting from the cost to go of the
+    untouched nodes around them.
+    '''
+    def __init__(self, G, goal, weight='weight'):
+        self.G = G
+        self.goal = goal
+        self.weight = weight
+        self.nodes = list(G.nodes)
+        self._index = {n: i for i, n in enumerate(self.nodes)}
+        # hop_distance -> arrays, see _prepare
+        self._graphs = {}
+        # the last field repaired around occupied nodes, (hop_distance, blocked) -> field
+        self._repaired = (None, None)
+        # How many full Dijkstras and local repairs we've had to run, and
+        # how many nodes the repairs settled again
+        self.searches = 0
+        self.repairs = 0
+        self.repaired_nodes = 0
+
+    def _prepare(self, hop_distance):
+        '''
+        Hoppable edges as CSR both ways, the unblocked cost to go and its
+        shortest path tree
+        '''
+        if hop_distance in self._graphs:
+            return self._graphs[hop_distance]
+        n = len(self.nodes)
+        a, b, w = [], [], []
+        for u, v, data in self.G.edges(data=True):
+            if data['dist'] <= hop_distance:
+                a.append(self._index[u])
+                b.append(self._index[v])
+                w.append(data.get(self.weight, 1))
+        # csgraph treats 0 as no edge
+        w = numpy.maximum(numpy.array(w, dtype=numpy.float64),
+                          numpy.finfo(numpy.float64).tiny)
+        out = csr_matrix((w, (a, b)), shape=(n, n))
+        into = csr_matrix((w, (b, a)), shape=(n, n))
+        self.searches += 1
+        cost, succ = dijkstra(into, indices=self._index[self.goal],
+                              return_predecessors=True)
+        # next node -> node, walking it from a node finds everything that
+        # goes through it
+        reached = numpy.flatnonzero(succ >= 0)
+        tree = csr_matrix((numpy.ones(len(reached)), (succ[reached], reached)),
+                          shape=(n, n))
+        graph = {
+            'out': out, 'into': into, 'cost': cost, 'tree': tree,
+            'field': {self.nodes[i]: c for i, c in enumerate(cost.tolist())
+                      if not math.isinf(c)},
+        }
+        self._graphs[hop_distance] = graph
+        return graph
+
+    def _repair(self, graph, blocked):
+        '''Field with blocked nodes (indices) taken out of the graph'''
+        cost, out, into = graph['cost'], graph['out'], graph['into']
+        # everything whose cheapest path runs through a blocked node
+        affected = numpy.zeros(len(self.nodes), dtype=bool)
+        for i in blocked:
+            if not affected[i]:
+                affected[breadth_first_order(graph['tree'], i,
+                                             return_predecessors=False)] = True
+        field = dict(graph['field'])
+        if not affected.any():
+            return field
+
+        self.repairs += 1
+        free = affected.copy()
+        free[list(blocked)] = False
+        rows = numpy.flatnonzero(free)
+        # Best way out of the affected region, to an untouched node
+        sub = out[rows]
+        owner = numpy.repeat(numpy.arange(len(rows)), numpy.diff(sub.indptr))
+        way_out = numpy.where(affected[sub.indices], numpy.inf,
+                              sub.data + cost[sub.indices])
+        seed = numpy.full(len(rows), numpy.inf)
+        numpy.minimum.at(seed, owner, way_out)
+        # Settle the affected nodes again from an extra node, joined to
+        # each of them by its way out
+        start = numpy.flatnonzero(numpy.isfinite(seed))
+        region = bmat([
+            [into[rows][:, rows], csr_matrix((len(rows), 1))],
+            [csr_matrix((numpy.maximum(seed[start], numpy.finfo(numpy.float64).tiny),
+                         (numpy.zeros(len(start), dtype=numpy.int64), start)),
+                        shape=(1, len(rows))), csr_matrix((1, 1))],
+        ], format='csr')
+        dist = dijkstra(region, indices=len(rows))[:-1]
+        self.repaired_nodes += len(rows)
+
+        for i in numpy.flatnonzero(affected).tolist():
+            field.pop(self.nodes[i], None)
+        for i, d in zip(rows.tolist(), dist.tolist()):
+            if not math.isinf(d):
+                field[self.nodes[i]] = d
+        return field
+
+    def field(self, hop_distance, blocked=frozenset()):
+        '''Cost to go of every node that can reach the goal, as a dict'''
+        graph = self._prepare(hop_distance)
+        if not blocked:
+            return graph['field']
+        key, field = self._repaired
+        if key != (hop_distance, blocked):
+            field = self._repair(graph, frozenset(
+                self._index[n] for n in blocked if n in self._index))
+            self._repaired = ((hop_distance, blocked), field)
+        return field
+
+    def next_hop(self, bot, bots=[]):
+        '''
+        Best node for bot to move to next: the cheapest neighbour in edge
+        weight plus cost to go that isn't occupied and keeps bot within
+        tether range of the other bots. If another bot sits on the best
+        one, the field is repaired around the occupied nodes first.
+        '''
+        node = bot.node
+        options = [n for n, w in self.G[node].items()
+                   if w['dist'] <= bot.hop_distance]
+        field = self.field(bot.hop_distance)
+
+        def cost(n, field):
+            return self.G[node][n].get(self.weight, 1) + field.get(n, math.inf)
+
+        best = min(options, key=lambda n: cost(n, field), default=None)
+        if best is not None and best.occupied:
+            blocked = frozenset(b.node for b in bots)
+            field = self.field(bot.hop_distance, blocked)
+        options = [n for n in options if can_hop(bot, n, bots)]
+        best = min(options, key=lambda n: cost(n, field), default=None)
+        if best is None or math.isinf(cost(best, field)):
+            raise nx.NetworkXNoPath('No move from %s towards %s' % (node, self.goal))
+        return best
+
+
+class CooperativePlanner:
+    '''
+    Windowed cooperative A*. Every bot's next window moves are planned
+    together, one bot at a time (the order rotates each round), each one
+    against a space-time reservation table of where the bots planned
+    before it will be. Bots not planned yet are assumed to stay put. The
+    tether is checked at every step, for the bot being planned and every
+    bot planned before it. The goal rooted CostToGo field is the
+    heuristic. Half the window is carried out before planning again.
+    '''
+    def __init__(self, G, goal, window=8, execute=None, wait_cost=25, weight='weight'):
+        self.G = G
+        self.goal = goal
+        self.window = window
+        self.execute = execute or max(1, window // 2)
+        # Waiting isn't free, or a bot has no reason to move early
+        self.wait_cost = wait_cost
+        self.weight = weight
+        self.cost_to_go = CostToGo(G, goal, weight)
+        # bot id -> nodes still to visit, starting with the current one
+        self._plans = {}
+        self._round = 0
+        # How many space-time searches we've run
+        self.searches = 0
+
+    @staticmethod
+    def _hub_distances(where):
+        '''Distance of every bot to the hub of the others, where is {bot: node}'''
+        distances = {}
+        for b, node in where.items():
+            others = [n for other, n in where.items() if other is not b]
+            if not others:
+                distances[b] = 0
+                continue
+            hub = [sum(c) / len(others) for c in
+                   zip(*[(n.x, n.y, n.z) for n in others])]
+            distances[b] = euclidean_distance_c(node, hub)
+        return distances
+
+    def _tether_ok(self, bot, node, t, positions, planned):
+        where = {b: path[t] for b, path in positions.items()}
+        where[bot] = node
+        distances = self._hub_distances(where)
+        return all(distances[b] <= self._slack[b] for b in [bot] + planned)
+
+    def _search(self, bot, positions, reserved, planned):
+        '''Space-time A* over (node, t) for one bot, returns window + 1 nodes or None'''
+        self.searches += 1
+        h = self.cost_to_go.field(bot.hop_distance)
+        if bot.node not in h:
+            return None
+        c = count()
+        queue = [(h[bot.node], next(c), bot.node, 0, 0)]
+        best = {(bot.node, 0): 0}
+        parent = {(bot.node, 0): None}
+        while queue:
+            _, __, node, t, g = heappop(queue)
+            if g > best[node, t]:
+                continue
+            if t == self.window or node == self.goal:
+                path = [node]
+                state = parent[node, t]
+                while state is not None:
+                    path.append(state[0])
+                    state = parent[state]
+                path.reverse()
+                # wait at the goal for the rest of the window
+                return path + [node] * (self.window + 1 - len(path))
+            moves = [(node, self.wait_cost)] + [
+                (n, w.get(self.weight, 1)) for n, w in self.G[node].items()
+                if w['dist'] <= bot.hop_distance]
+            for n, cost in moves:
+                if n not in h:
+                    continue
+                # Nobody else there at the same time. Bots move one after
+                # the other in id order within a turn, so we can only
+                # follow a bot out of a node if it moves first, and only
+                # a bot that moves after us can follow us out
+                if reserved.get((n, t + 1), bot.id) != bot.id or \
+                        reserved.get((n, t), -1) > bot.id or \
+                        reserved.get((n, t + 2), math.inf) < bot.id:
+                    continue
+                if not self._tether_ok(bot, n, t + 1, positions, planned):
+                    continue
+                ng = g + cost
+                if ng < best.get((n, t + 1), math.inf):
+                    best[n, t + 1] = ng
+                    parent[n, t + 1] = (node, t)
+                    heappush(queue, (ng + h[n], next(c), n, t + 1, ng))
+        return None
+
+    def plan(self, bots):
+        '''Plan all bots jointly, returns {bot: [node at t = 0..window]}'''
+        shift = self._round % len(bots)
+        self._round += 1
+        order = bots[shift:] + bots[:shift]
+        steps = range(self.window + 1)
+        # everyone stays put until they're planned
+        positions = {b: [b.node] * (self.window + 1) for b in bots}
+        # A bot that's already past the tether (somebody got stuck) can't
+        # be made to go further out, but don't let that block everyone
+        self._slack = {b: max(b.tether_distance, d) for b, d in
+                       self._hub_distances({b: b.node for b in bots}).items()}
+        reserved = {(b.node, t): b.id for b in bots for t in steps}
+        planned = []
+        for bot in order:
+            for t in steps:
+                del reserved[bot.node, t]
+            path = self._search(bot, positions, reserved, planned)
+            if path is None:
+                # stuck, sit tight and let the others work around us
+                path = [bot.node] * (self.window + 1)
+            for t, node in enumerate(path):
+                reserved[node, t] = bot.id
+            positions[bot] = path
+            planned.append(bot)
+        return positions
+
+    def next_hop(self, bot, bots=[]):
+        '''
+        Next node for bot from the joint plan, planning again for everyone
+        once bot's share of it is used up or it went off plan. Waiting is
+        part of the plan, so bot.node can come back. Raises if nobody
+        can move at all.
+        '''
+        plan = self._plans.get(bot.id)
+        if not plan or len(plan) < 2 or plan[0] is not bot.node:
+            everyone = sorted(bots + [bot], key=lambda b: b.id)
+            plans = self.plan(everyone)
+            if all(len(set(path)) == 1 for path in plans.values()):
+                self._plans = {}
+                raise nx.NetworkXNoPath('No bot can move towards %s' % self.goal)
+            self._plans = {b.id: path[:self.execute + 1] for b, path in plans.items()}
+            plan = self._plans[bot.id]
+        self._plans[bot.id] = plan[1:]
+        return plan[1]
@@ -0,0 +1,305 @@
+# Contraction hierarchy over the handhold graph
+#
+# Nodes are contracted one at a time, least important first. Contracting v
+# removes it and adds a shortcut u -> x (weight w(u, v) + w(v, x)) for every
+# in/out pair whose cheapest path went through v. A query is then a
+# bidirectional Dijkstra that only ever goes up in contraction order, which
+# settles a tiny part of the graph, and shortcuts are unpacked back into
+# real edges at the end.
+#
+# Only edges a bot can hop (dist <= hop_distance) are used, so a hierarchy
+# is built for one hop distance. It knows nothing about occupancy or the
+# tether, the planner checks those and falls back to bounded_leg_astar.
+#
+# The handhold graph is a nearest neighbour graph over a closed surface, so
+# the nodes left late in the order pile up shortcuts and every contraction
+# gets slower (on itokawa the average degree goes from 40 to 250 two thirds
+# of the way through, and contracting everything never finished). So
+# contraction stops once the cheapest node left has more than core_degree
+# edges. The rest is the core: it keeps its edges uncontracted, and a query
+# goes up to the core from both ends and crosses it with one scipy
+# Dijkstra. Still exact, a shortest path goes up to the core, through it
+# and down. On itokawa (24577 holds, 491447 edges) the default contracts
+# the sparse fringe, builds in ~11 s and answers in ~9 ms. Contracting
+# further only made both slower, 80 took 100 s / 13 ms and 150 took 210 s /
+# 18 ms.
+#
+# The whole thing is a handful of arrays (rank, and every edge with its
+# weight and middle node) so it goes in the cache next to the handholds.
+
+from heapq import heapify, heappush, heappop
+import math
+
+import numpy
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+
+
+class ContractionHierarchy:
+    def __init__(self, rank, edge_a, edge_b, weight, middle, ids=None, core=None):
+        '''
+        rank is the contraction order of each node. Edge i goes
+        edge_a[i] -> edge_b[i], and is a shortcut through middle[i], or a
+        real edge if middle[i] is -1. ids are the Node.IDs of the nodes.
+        Nodes ranked core or higher weren't contracted.
+        '''
+        self.rank = numpy.asarray(rank)
+        self.edge_a = numpy.asarray(edge_a)
+        self.edge_b = numpy.asarray(edge_b)
+        self.weight = numpy.asarray(weight)
+        self.middle = numpy.asarray(middle)
+        self.ids = None if ids is None else numpy.asarray(ids)
+        n = len(self.rank)
+        self.core = n if core is None else int(numpy.asarray(core).item())
+        a, b, w = self.edge_a.tolist(), self.edge_b.tolist(), self.weight.tolist()
+        rank = self.rank.tolist()
+        # forward search goes up out edges, backward search goes up in edges
+        self._up = [[] for _ in range(n)]
+        self._down = [[] for _ in range(n)]
+        self._edges = {}
+        # the core as CSR, with a spare last row for the query to start from
+        self._core_nodes = numpy.flatnonzero(self.rank >= self.core)
+        self._local = numpy.full(n, -1, dtype=numpy.int64)
+        self._local[self._core_nodes] = numpy.arange(len(self._core_nodes))
+        inside = (self.rank[self.edge_a] >= self.core) & (self.rank[self.edge_b] >= self.core)
+        k = len(self._core_nodes)
+        # csgraph treats 0 as no edge
+        self._core_graph = csr_matrix(
+            (numpy.maximum(self.weight[inside], numpy.finfo(numpy.float64).tiny),
+             (self._local[self.edge_a[inside]], self._local[self.edge_b[inside]])),
+            shape=(k + 1, k + 1))
+        for i, (u, x, cost) in enumerate(zip(a, b, w)):
+            self._edges[u, x] = int(self.middle[i])
+            if inside[i]:
+                continue
+            if rank[x] > rank[u]:
+                self._up[u].append((x, cost))
+            else:
+                self._down[x].append((u, cost))
+        self._position = None if ids is None else \
+            {ID: i for i, ID in enumerate(self.ids.tolist())}
+
+    @classmethod
+    def build(cls, edge_a, edge_b, weight, n: int, ids=None,
+              witness_limit: int=50, hop_limit: int=5, core_degree: int=40):
+        '''
+        Contract a graph of n nodes with directed edges edge_a -> edge_b.
+        Witness searches give up after settling witness_limit nodes or
+        going hop_limit edges deep, which can only cost extra shortcuts,
+        never wrong answers. Nodes with more than core_degree edges by the
+        time they come up are left in the core.
+        '''
+        out = [{} for _ in range(n)]
+        inc = [{} for _ in range(n)]
+        middle = {}
+        for u, x, w in zip(numpy.asarray(edge_a).tolist(),
+                           numpy.asarray(edge_b).tolist(),
+                           numpy.asarray(weight).tolist()):
+            if u != x and w < out[u].get(x, math.inf):
+                out[u][x] = inc[x][u] = w
+                middle[u, x] = -1
+
+        def witness(u, skip, limit, targets):
+            '''Costs from u avoiding skip, up to limit or until targets are settled'''
+            dist = {u: 0}
+            queue = [(0, 0, u)]
+            settled = 0
+            remaining = len(targets)
+            while queue and settled < witness_limit and remaining:
+                d, hops, node = heappop(queue)
+                if d > dist[node]:
+                    continue
+                if d > limit:
+                    break
+                settled += 1
+                if node in targets:
+                    remaining -= 1
+                if hops == hop_limit:
+                    continue
+                for x, w in out[node].items():
+                    if x == skip:
+                        continue
+                    nd = d + w
+                    if nd < dist.get(x, math.inf):
+                        dist[x] = nd
+                        heappush(queue, (nd, hops + 1, x))
+            return dist
+
+        def shortcuts(v):
+            needed = []
+            if not out[v]:
+                return needed
+            limit = max(out[v].values())
+            targets = set(out[v])
+            for u, w_in in inc[v].items():
+                dist = witness(u, v, w_in + limit, targets - {u})
+                for x, w_out in out[v].items():
+                    if x != u and dist.get(x, math.inf) > w_in + w_out:
+                        needed.append((u, x, w_in + w_out))
+            return needed
+
+        # Every in/out pair standing in for the shortcuts, no witness
+        # searches, plus how many neighbours are gone already so the
+        # contraction spreads out over the graph
+        deleted = [0] * n
+
+        def priority(v):
+            both = len(inc[v].keys() & out[v].keys())
+            return len(inc[v]) * len(out[v]) - both - len(inc[v]) - len(out[v]) + deleted[v]
+
+        current = [priority(v) for v in range(n)]
+        queue = [(p, v) for v, p in enumerate(current)]
+        heapify(queue)
+        contracted = numpy.zeros(n, dtype=bool)
+        rank = numpy.zeros(n, dtype=numpy.int64)
+        edges = []
+        order = 0
+        while queue:
+            p, v = heappop(queue)
+            if contracted[v] or p != current[v]:
+                continue
+            if len(inc[v]) + len(out[v]) > core_degree:
+                break
+            for u, x, w in shortcuts(v):
+                if w < out[u].get(x, math.inf):
+                    out[u][x] = inc[x][u] = w
+                    middle[u, x] = v
+            # every edge is recorded when its lower end is contracted
+            for u, w in inc[v].items():
+                edges.append((u, v, w, middle[u, v]))
+                del out[u][v]
+            for x, w in out[v].items():
+                edges.append((v, x, w, middle[v, x]))
+                del inc[x][v]
+            neighbours = inc[v].keys() | out[v].keys()
+            out[v], inc[v] = {}, {}
+            contracted[v] = True
+            rank[v] = order
+            order += 1
+            for u in neighbours:
+                deleted[u] += 1
+                current[u] = priority(u)
+                heappush(queue, (current[u], u))
+
+        core = order
+        for v in numpy.flatnonzero(~contracted).tolist():
+            edges.extend((v, x, w, middle[v, x]) for x, w in out[v].items())
+            rank[v] = order
+            order += 1
+
+        a, b, w, m = zip(*edges) if edges else ((), (), (), ())
+        return cls(rank, numpy.array(a, dtype=numpy.int64),
+                   numpy.array(b, dtype=numpy.int64), numpy.array(w),
+                   numpy.array(m, dtype=numpy.int64), ids, core)
+
+    def to_arrays(self) -> dict:
+        arrays = {'rank': self.rank, 'edge_a': self.edge_a, 'edge_b': self.edge_b,
+                  'weight': self.weight, 'middle': self.middle,
+                  'core': numpy.array([self.core])}
+        if self.ids is not None:
+            arrays['ids'] = self.ids
+        return arrays
+
+    def _unpack(self, u, x, path):
+        m = self._edges[u, x]
+        if m < 0:
+            path.append(x)
+        else:
+            self._unpack(u, m, path)
+            self._unpack(m, x, path)
+
+    def query(self, s: int, t: int):
+        '''Cost and path (list of nodes) of the cheapest s -> t path, or (inf, None)'''
+        if s == t:
+            return 0, [s]
+        dist = ({s: 0}, {t: 0})
+        parent = ({s: None}, {t: None})
+        queues = ([(0, s)], [(0, t)])
+        adjacency = (self._up, self._down)
+        rank, core = self.rank, self.core
+        best, meet = math.inf, None
+        while queues[0] or queues[1]:
+            # can't do better than best once both sides are past it
+            if min(q[0][0] if q else math.inf for q in queues) >= best:
+                break
+            side = 0 if queues[0] and (not queues[1] or queues[0][0] <= queues[1][0]) else 1
+            d, node = heappop(queues[side])
+            if d > dist[side][node]:
+                continue
+            other = dist[1 - side].get(node)
+            if other is not None and d + other < best:
+                best, meet = d + other, node
+            if rank[node] >= core:
+                # the core is crossed below
+                continue
+            for x, w in adjacency[side][node]:
+                nd = d + w
+                if nd < dist[side].get(x, math.inf):
+                    dist[side][x] = nd
+                    parent[side][x] = node
+                    heappush(queues[side], (nd, x))
+
+        crossing = self._cross(dist, best)
+        if crossing is not None:
+            best, meet = crossing[0], None
+        if math.isinf(best):
+            return math.inf, None
+
+        # up from s to the meeting node (or across the core), then down to t
+        up = [meet] if meet is not None else list(crossing[1])
+        while parent[0][up[-1]] is not None:
+            up.append(parent[0][up[-1]])
+        up.reverse()
+        down = [up[-1]]
+        while parent[1][down[-1]] is not None:
+            down.append(parent[1][down[-1]])
+        hops = up + down[1:]
+        path = [hops[0]]
+        for u, x in zip(hops, hops[1:]):
+            self._unpack(u, x, path)
+        return best, path
+
+    def _cross(self, dist, best):
+        '''
+        Cheapest way across the core, given the costs up to it from both
+        ends, as (cost, nodes across it), or None if it's no better than
+        best
+        '''
+        ends = []
+        for side in dist:
+            nodes = [v for v in side if self.rank[v] >= self.core]
+            ends.append((self._local[nodes], numpy.array([side[v] for v in nodes])))
+        (entry, up), (exit, down) = ends
+        if not len(entry) or not len(exit):
+            return None
+        # start from the spare row, joined to where the up search got in
+        k = len(self._core_nodes)
+        graph = self._core_graph.copy()
+        graph.indptr[-1] += len(entry)
+        graph.indices = numpy.concatenate([graph.indices, entry])
+        graph.data = numpy.concatenate(
+            [graph.data, numpy.maximum(up, numpy.finfo(numpy.float64).tiny)])
+        across, previous = dijkstra(graph, indices=k, limit=best,
+                                    return_predecessors=True)
+        total = across[exit] + down
+        i = total.argmin()
+        if not total[i] < best:
+            return None
+        nodes = [exit[i]]
+        while previous[nodes[-1]] != k:
+            nodes.append(previous[nodes[-1]])
+        return float(total[i]), self._core_nodes[nodes].tolist()
+
+    def node_path(self, source, target, nodes):
+        '''
+        query() for Node objects. nodes maps Node.ID to Node, path is a
+        list of Nodes or None.
+        '''
+        s = self._position.get(source.ID)
+        t = self._position.get(target.ID)
+        if s is None or t is None:
+            return None
+        _, path = self.query(s, t)
+        if path is None:
+            return None
+        return [nodes[ID] for ID in self.ids[path].tolist()]
@@ -0,0 +1,140 @@
+# Batched flatness scoring for the Planar detector
+#
+# Same loss as handhold_detectors.compute_flatness, but for a whole block of
+# vertices at a time with no sklearn and no per vertex python:
+#
+#   1. radius neighbourhood of every vertex, Neighborhoods.euclidean
+#   2. plane z = a x + b y + c fit per neighbourhood in closed form, from
+#      moment sums that are segmented reductions (bincount) over the
+#      neighbour index array
+#   3. MSE of the fit falls out of the same sums
+#   4. the gradient term (numpy.gradient of the 1-ring, crossed with the
+#      plane gradient) is done for every ring entry at once
+#
+# Vertices are done in chunks so the neighbour arrays stay small, a big
+# mesh can have thousands of neighbours per vertex. parallel_flatness hands
+# the chunks out to worker processes.
+
+import numpy
+from scipy.spatial import cKDTree
+
+from neighborhoods import Neighborhoods
+import parallel
+
+
+def plane_fit(points: numpy.ndarray, rows: numpy.ndarray, hoods: Neighborhoods):
+    '''
+    Least squares plane z = a x + b y + c through each neighbourhood.
+    Returns a, b, the MSE of the fit and the neighbourhood sizes.
+    Degenerate neighbourhoods (collinear, too few points) get the minimum
+    norm solution, same as LinearRegression.
+    '''
+    owner = hoods.owners()
+    count = hoods.sizes().astype(numpy.float64)
+    # relative to the centre vertex, keeps the sums well conditioned
+    d = points[hoods.idx] - points[rows][owner]
+
+    def total(weights):
+        return numpy.bincount(owner, weights=weights, minlength=len(rows))
+
+    x, y, z = d[:, 0], d[:, 1], d[:, 2]
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        mx, my, mz = total(x) / count, total(y) / count, total(z) / count
+        # centred second moments, summed over the neighbourhood
+        cxx = total(x * x) - count * mx * mx
+        cxy = total(x * y) - count * mx * my
+        cyy = total(y * y) - count * my * my
+        cxz = total(x * z) - count * mx * mz
+        cyz = total(y * z) - count * my * mz
+        czz = total(z * z) - count * mz * mz
+
+        det = cxx * cyy - cxy * cxy
+        a = (cyy * cxz - cxy * cyz) / det
+        b = (cxx * cyz - cxy * cxz) / det
+
+    singular = ~(det > 1e-12 * cxx * cyy) & (count > 0)
+    if singular.any():
+        cov = numpy.stack([cxx, cxy, cxy, cyy], axis=1)[singular].reshape(-1, 2, 2)
+        rhs = numpy.stack([cxz, cyz], axis=1)[singular]
+        ab = numpy.einsum('nij,nj->ni', numpy.linalg.pinv(cov), rhs)
+        a[singular], b[singular] = ab[:, 0], ab[:, 1]
+
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        mse = numpy.maximum(czz - a * cxz - b * cyz, 0) / count
+    return a, b, mse, count
+
+
+def ring_gradient_loss(points: numpy.ndarray, rows: numpy.ndarray,
+                       indptr: numpy.ndarray, indices: numpy.ndarray,
+                       a: numpy.ndarray, b: numpy.ndarray) -> numpy.ndarray:
+    '''
+    For each of rows: numpy.gradient of its 1-ring coords (in adjacency
+    order) along both axes, crossed with the plane gradient (a, b, a + b),
+    and the norms of the two results summed.
+    '''
+    start, stop = indptr[rows], indptr[rows + 1]
+    size = stop - start
+    owner = numpy.repeat(numpy.arange(len(rows)), size)
+    entry = numpy.repeat(start, size) + \
+        numpy.arange(size.sum()) - numpy.repeat(numpy.cumsum(size) - size, size)
+    q = points[indices[entry]]
+    first = entry == start[owner]
+    last = entry == stop[owner] - 1
+
+    # along the ring: one sided at the ends, central in the middle
+    nxt = q[numpy.minimum(numpy.arange(len(q)) + 1, len(q) - 1)]
+    prv = q[numpy.maximum(numpy.arange(len(q)) - 1, 0)]
+    g0 = (numpy.where(last[:, None], q, nxt) - numpy.where(first[:, None], q, prv))
+    g0 /= numpy.where(first | last, 1, 2)[:, None]
+    # a single neighbour has nothing to take a gradient along
+    g0[first & last] = 0
+    # across each point's own (x, y, z)
+    g1 = numpy.stack([q[:, 1] - q[:, 0],
+                      (q[:, 2] - q[:, 0]) / 2,
+                      q[:, 2] - q[:, 1]], axis=1)
+
+    m = numpy.stack([a, b, a + b], axis=1)[owner]
+    loss = numpy.zeros(len(rows))
+    for g in (g0, g1):
+        sq = numpy.einsum('ij,ij->i', *(2 * [numpy.cross(g, m)]))
+        loss += numpy.sqrt(numpy.bincount(owner, weights=sq, minlength=len(rows)))
+    return loss
+
+
+def flatness(points: numpy.ndarray, indptr: numpy.ndarray, indices: numpy.ndarray,
+             radius: float=50, alpha: float=0.1, rows: numpy.ndarray=None,
+             tree: cKDTree=None, chunk: int=1024) -> numpy.ndarray:
+    '''
+    Flatness loss of rows (default all vertices), lower is flatter.
+    indptr/indices is the CSR 1-ring adjacency. Vertices with nobody
+    within radius get inf.
+    '''
+    tree = tree or cKDTree(points)
+    if rows is None:
+        rows = numpy.arange(len(points))
+    losses = numpy.empty(len(rows))
+    for lo in range(0, len(rows), chunk):
+        block = rows[lo:lo + chunk]
+        hoods = Neighborhoods.euclidean(points, radius, tree, rows=block)
+        a, b, mse, count = plane_fit(points, block, hoods)
+        loss = ring_gradient_loss(points, block, indptr, indices, a, b) + alpha * mse
+        loss[count == 0] = numpy.inf
+        losses[lo:lo + chunk] = loss
+    return losses
+
+
+def _score(arrays, local, lo, hi, radius, alpha):
+    '''parallel.map_chunks worker, one KD-tree per worker'''
+    if 'tree' not in local:
+        local['tree'] = cKDTree(arrays['points'])
+    return flatness(arrays['points'], arrays['indptr'], arrays['indices'],
+                    radius, alpha, rows=numpy.arange(lo, hi), tree=local['tree'])
+
+
+def parallel_flatness(points: numpy.ndarray, indptr: numpy.ndarray,
+                      indices: numpy.ndarray, radius: float=50, alpha: float=0.1,
+                      processes: int=None, chunk: int=1024) -> numpy.ndarray:
+    '''flatness of every vertex, chunks spread over processes workers'''
+    arrays = {'points': points, 'indptr': indptr, 'indices': indices}
+    return parallel.map_chunks(_score, arrays, len(points), (radius, alpha),
+                               processes, chunk)
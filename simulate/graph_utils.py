@@ -4,6 +4,8 @@ import math
 # circular deps
 
 RISK_WEIGHT = 0.25
+# Furthest a bot can hop (and the longest handhold edge worth building)
+MAX_HOP_DISTANCE = 100
 
 def euclidean_distance(a, b):
     return math.sqrt(
@@ -12,12 +12,18 @@ import multiprocessing
 import sys
 from typing import List
 import random
+import weakref
 from scipy.signal import convolve2d
+from scipy.spatial import cKDTree
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components, minimum_spanning_tree
 import scipy
 
 from compute_path import bounded_leg_astar
+from graph_constructor import Node
+import flatness
 import phase_timer
-from graph_utils import euclidean_distance, compute_cost
+from graph_utils import euclidean_distance, compute_cost, RISK_WEIGHT, MAX_HOP_DISTANCE
 
 
 flat_q = multiprocessing.Queue()
@@ -62,13 +68,147 @@ def score_local_maximum(graph, node):
     return 0.1 * sum(dists)
 
 
-def euclidean_neighbors(graph, node, distance):
+# graph -> (KD-tree, node list). Not kept on the graph itself, it would
+# go along every time the graph gets pickled (ie. to worker processes)
+_spatial_indexes = weakref.WeakKeyDictionary()
+
+
+def spatial_index(graph):
+    '''
+    KD-tree over the coords of the graph's nodes, and the node list it
+    indexes. Built once per graph.
+    '''
+    index = _spatial_indexes.get(graph)
+    if index is None or len(index[1]) != graph.number_of_nodes():
+        nodes = list(graph.nodes)
+        tree = cKDTree(numpy.array([(n.x, n.y, n.z) for n in nodes]).reshape(-1, 3))
+        index = _spatial_indexes[graph] = (tree, nodes)
+    return index
+
+
+def euclidean_neighbors(graph, node, distance, geodesic=False):
+    '''
+    Return the all nodes within given euclidean distance of the given node.
+    If geodesic, distance is measured along graph edges instead (the ego
+    graph of the node), which is a lot slower.
+    '''
+    if geodesic:
+        g = nx.ego_graph(graph, node, distance, center=False, distance='dist')
+        return g.nodes
+    tree, nodes = spatial_index(graph)
+    return [nodes[i]
+            for i in tree.query_ball_point((node.x, node.y, node.z), distance)
+            if nodes[i] is not node]
+
+
+def knn_edges(points, k=20, max_distance=None):
+    '''
+    Directed edges from every point to its k nearest other points, from a
+    single KD-tree query. Neighbours further than max_distance are left
+    out. Returns (a, b, dist) arrays of edges a -> b, indices into points.
+    '''
+    n = len(points)
+    if n < 2:
+        empty = numpy.empty(0, dtype=numpy.int64)
+        return empty, empty, numpy.empty(0)
+    tree = cKDTree(points)
+    dist, idx = tree.query(
+        points, min(k + 1, n),
+        distance_upper_bound=numpy.inf if max_distance is None else max_distance)
+    dist, idx = dist.reshape(n, -1), idx.reshape(n, -1)
+    rows = numpy.broadcast_to(numpy.arange(n)[:, None], idx.shape)
+    # missing neighbours come back as idx n. Self usually comes first but
+    # not always if points are duplicated, so drop it and trim back to k
+    keep = (idx != rows) & (idx < n)
+    keep &= numpy.cumsum(keep, axis=1) <= k
+    return rows[keep], idx[keep], dist[keep]
+
+
+def loss_mst_edges(points, loss, risk_weight=RISK_WEIGHT, k=8):
+    '''
+    Exact minimum spanning tree of the complete graph over points, where an
+    edge costs the cheaper direction of compute_cost, ie. dist +
+    risk_weight * min(loss[a], loss[b]). Returns (a, b) arrays of the tree
+    edges, indices into points.
+
+    Boruvka over a KD-tree: every round each component takes its cheapest
+    edge out. A point looks at its k nearest neighbours, and anything past
+    the kth costs at least its distance plus the smallest penalty going, so
+    k only doubles for points that could still beat their component's best.
     '''
-    Return all nodes that form an ego graph of a node. In other words
-    return the all nodes within given euclidean distance of the given node.
+    n = len(points)
+    empty = numpy.empty(0, dtype=numpy.int64)
+    if n < 2:
+        return empty, empty
+    tree = cKDTree(points)
+    penalty = risk_weight * numpy.asarray(loss, dtype=numpy.float64)
+    floor = penalty.min()
+    chosen_a, chosen_b, chosen_cost = [empty], [empty], [numpy.empty(0)]
+    while True:
+        a, b = numpy.concatenate(chosen_a), numpy.concatenate(chosen_b)
+        n_parts, labels = connected_components(
+            coo_matrix((numpy.ones(len(a)), (a, b)), shape=(n, n)), directed=False)
+        if n_parts == 1:
+            break
+        best = numpy.full(n, numpy.inf)
+        best_to = numpy.full(n, -1)
+        todo = numpy.arange(n)
+        kk = k
+        while len(todo):
+            kq = min(kk, n)
+            # keep the (rows, kq) arrays to a few million entries
+            step = max(1, (1 << 22) // kq)
+            bound = numpy.empty(len(todo))
+            for lo in range(0, len(todo), step):
+                rows = todo[lo:lo + step]
+                dist, idx = tree.query(points[rows], kq)
+                dist, idx = dist.reshape(len(rows), -1), idx.reshape(len(rows), -1)
+                cost = dist + numpy.minimum(penalty[rows, None], penalty[idx])
+                cost[labels[idx] == labels[rows, None]] = numpy.inf
+                j = cost.argmin(axis=1)
+                c = cost[numpy.arange(len(rows)), j]
+                better = c < best[rows]
+                best[rows[better]] = c[better]
+                best_to[rows[better]] = idx[numpy.arange(len(rows)), j][better]
+                bound[lo:lo + step] = dist[:, -1] + numpy.minimum(penalty[rows], floor)
+            if kq >= n:
+                break
+            part_best = numpy.full(n_parts, numpy.inf)
+            numpy.minimum.at(part_best, labels, best)
+            todo = todo[part_best[labels[todo]] > bound]
+            kk *= 2
+        # cheapest edge out of each component
+        order = numpy.lexsort((best, labels))
+        first = numpy.ones(n, dtype=bool)
+        first[1:] = labels[order][1:] != labels[order][:-1]
+        pick = order[first]
+        pick = pick[numpy.isfinite(best[pick])]
+        if not len(pick):
+            break
+        chosen_a.append(pick)
+        chosen_b.append(best_to[pick])
+        chosen_cost.append(best[pick])
+
+    # Equal costs can give Boruvka a cycle, the MST of what it picked can't.
+    # csgraph treats 0 as no edge, keep duplicate points connected
+    a, b = numpy.concatenate(chosen_a), numpy.concatenate(chosen_b)
+    cost = numpy.maximum(numpy.concatenate(chosen_cost), numpy.finfo(numpy.float64).tiny)
+    mst = minimum_spanning_tree(coo_matrix((cost, (a, b)), shape=(n, n)).tocsr()).tocoo()
+    return mst.row.astype(numpy.int64), mst.col.astype(numpy.int64)
+
+
+def adjacency_arrays(graph, nodes):
     '''
-    g = nx.ego_graph(graph, node, distance, center=False, distance='dist')
-    return g.nodes
+    CSR (indptr, indices) adjacency of graph, indices into nodes. Keeps
+    the graph's own neighbour order, which the flatness gradient depends on.
+    '''
+    position = {node: i for i, node in enumerate(nodes)}
+    indptr = numpy.zeros(len(nodes) + 1, dtype=numpy.int64)
+    numpy.cumsum([len(graph.adj[node]) for node in nodes], out=indptr[1:])
+    indices = numpy.fromiter(
+        (position[n] for node in nodes for n in graph.adj[node]),
+        dtype=numpy.int64, count=indptr[-1])
+    return indptr, indices
 
 
 def compute_flatness_model_loss(graph, node, distance=300) -> float:
@@ -198,57 +338,107 @@ class HandHoldGraph:
         '''
         raise NotImplementedError()
 
-    def _build_emst(self, nodes, loss_weight=0) -> None:
+    def to_arrays(self) -> dict:
+        '''
+        Compact array form of the results for caching, see from_arrays.
+        Nodes are referred to by Node.ID (their vertex index).
         '''
-        Given a list of nodes, builds as complete euclidean graph.
-        Returns the euclidean minimum spanning tree of the graph.
+        loss = numpy.full(self._g.number_of_nodes(), numpy.nan)
+        for node in self._g.nodes:
+            if node.loss is not None:
+                loss[node.ID] = node.loss
+        edges = list(self.g.edges(data=True))
+        return {
+            'loss': loss,
+            'holds': numpy.array([n.ID for n in self.g.nodes], dtype=numpy.int64),
+            'edge_a': numpy.array([a.ID for a, b, _ in edges], dtype=numpy.int64),
+            'edge_b': numpy.array([b.ID for a, b, _ in edges], dtype=numpy.int64),
+            'weight': numpy.array([d['weight'] for _, _, d in edges]),
+            'dist': numpy.array([d['dist'] for _, _, d in edges]),
+        }
+
+    @classmethod
+    def from_arrays(cls, vertices, loss, holds, edge_a, edge_b, weight, dist):
         '''
+        Rebuild the handhold graph from to_arrays output without the full
+        mesh graph. Only the handhold nodes get Node objects.
+        '''
+        h = cls.__new__(cls)
+        h._g = None
+        nodes = {}
+        for i in numpy.asarray(holds).tolist():
+            node = Node(i, vertices[i].tolist())
+            node.loss = float(loss[i])
+            nodes[i] = node
         g = nx.DiGraph()
-        g.add_nodes_from(nodes)
-        # itertools does something weird here where it empties nodes, so deepcopy
+        g.add_nodes_from(nodes.values())
+        g.add_edges_from(
+            (nodes[a], nodes[b], {'weight': w, 'dist': d})
+            for a, b, w, d in zip(numpy.asarray(edge_a).tolist(),
+                                  numpy.asarray(edge_b).tolist(),
+                                  numpy.asarray(weight).tolist(),
+                                  numpy.asarray(dist).tolist()))
+        h.g = g
+        return h
+
+    def _build_emst(self, nodes) -> None:
+        '''
+        Given a list of nodes, builds the minimum spanning tree of the
+        complete graph over them, with compute_cost as the edge cost (the
+        cheaper direction of it, the tree is undirected). See
+        loss_mst_edges, it's exact and O(n) memory.
+        '''
+        points = numpy.array([(node.x, node.y, node.z) for node in nodes]).reshape(-1, 3)
+        loss = numpy.array([node.loss for node in nodes], dtype=numpy.float64)
+        tree_a, tree_b = loss_mst_edges(points, loss)
+
         # edges must be bidirectional, as weight from a good node to bad node
         # should be different than a bad node to good node
-        all_possible_edges = list(itertools.permutations(nodes, 2))
-        for edge in all_possible_edges:
-            g.add_edge(*edge, weight=compute_cost(*edge))
-
-        self.g = nx.minimum_spanning_tree(g)
+        a = numpy.concatenate([tree_a, tree_b])
+        b = numpy.concatenate([tree_b, tree_a])
+        dist = numpy.linalg.norm(points[a] - points[b], axis=1)
+        weight = dist + RISK_WEIGHT * loss[b]
+        g = nx.DiGraph()
+        g.add_nodes_from(nodes)
+        g.add_edges_from(
+            (nodes[i], nodes[j], {'weight': w, 'dist': d})
+            for i, j, w, d in zip(a.tolist(), b.tolist(),
+                                  weight.tolist(), dist.tolist()))
+        self.g = g
 
-    def guess_edges(self, nodes, neighbor_len=20) -> List:
+    def guess_edges(self, nodes, neighbor_len=20, max_distance=None) -> List:
         '''
         Given a bunch of nodes in 3d space, guess some edges for each node.
         The optimal way would be to generate a complete graph (where every node
         is connected to every other node), but the minimum spanning aborescence
-        causes tons of page faults and thrashes my disk. 
+        causes tons of page faults and thrashes my disk. So connect each
+        node to its neighbor_len nearest nodes (within max_distance) instead.
         '''
-        edges = []
-        for node in nodes:
-            closest_nodes = sorted(
-                nodes,
-                key=lambda x: euclidean_distance(node, x))[:neighbor_len]
-            edges += [(node, neighbor) for neighbor in closest_nodes]
-        return edges
-
-    def build_edges(self, nodes, risk_weight=1):
+        points = numpy.array([(n.x, n.y, n.z) for n in nodes]).reshape(-1, 3)
+        a, b, _ = knn_edges(points, neighbor_len, max_distance)
+        return [(nodes[i], nodes[j]) for i, j in zip(a.tolist(), b.tolist())]
+
+    def build_edges(self, nodes, risk_weight=1, neighbor_len=20,
+                    max_distance=MAX_HOP_DISTANCE):
         '''
-        Given a list of nodes, builds as complete euclidean graph.
-        Returns the aborescence (directed analog of euclidean minimum 
-        spanning tree) of the graph.
+        Given a list of nodes, connects each to its neighbor_len nearest
+        nodes. Edges longer than max_distance can't be hopped anyway, so
+        they aren't built.
         '''
         print('Building edges...')
         print(len(nodes))
         with phase_timer.Timer():
             g = nx.DiGraph()
             g.add_nodes_from(nodes)
-            edges = self.guess_edges(nodes)
-            # three-ple of node, node, weight
-            ebunch = [
-                (edge[0], edge[1], compute_cost(*edge))
-            for edge in edges]
-            g.add_weighted_edges_from(ebunch)
-            # Prepopulate edge distance
-            for a, b in g.edges:
-                g[a][b]['dist'] = euclidean_distance(a, b)
+            points = numpy.array([(n.x, n.y, n.z) for n in nodes]).reshape(-1, 3)
+            loss = numpy.array([n.loss for n in nodes], dtype=numpy.float64)
+            a, b, dist = knn_edges(points, neighbor_len, max_distance)
+            # same as compute_cost, for every edge at once
+            weight = dist + RISK_WEIGHT * loss[b]
+            g.add_edges_from(
+                (nodes[i], nodes[j], {'weight': w, 'dist': d})
+                for i, j, w, d in zip(a.tolist(), b.tolist(),
+                                      weight.tolist(), dist.tolist()))
             self.g = g
 
     def get_path(self, start_node=None, goal_node=None, risk_weight=0.1):
@@ -278,27 +468,34 @@ class HandHoldGraph:
 class Planar(HandHoldGraph):
     '''For microspine grippers. Search for a flat, planar surface.'''
 
-    def get_graph(self, percentile=25):
-        '''Get graph of only the flattest surfaces'''
+    def get_graph(self, percentile=25, tree=False):
+        '''
+        Get graph of only the flattest surfaces. If tree, the holds are
+        joined by their minimum spanning tree instead of nearest neighbours.
+        '''
         assert (percentile > 0 and percentile < 100)
 
         print('Computing flatness for {} verticies...'.format(
             self._g.number_of_nodes()))
         with phase_timer.Timer():
-            # sklearn is super duper slow to generate linear models
-            # sidestep python GIL, and raise the temp of my room 5 degrees
-            p = multiprocessing.Pool(12)
-            flatness_losses = p.starmap(
-                compute_flatness, [(self._g, node) for node in self._g.nodes])
-            # I hope the node iterator is ordered...
+            # sklearn is super duper slow to generate linear models, so
+            # fit every vertex's plane at once in closed form instead, and
+            # still raise the temp of my room 5 degrees with every core
+            index, nodes = spatial_index(self._g)
+            indptr, indices = adjacency_arrays(self._g, nodes)
+            flatness_losses = flatness.parallel_flatness(
+                numpy.asarray(index.data), indptr, indices, radius=50, alpha=0.1)
             # For decimated example, flatness losses vary between 25 and 3000
-            for idx, node in enumerate(self._g.nodes):
+            for idx, node in enumerate(nodes):
                 node.loss = flatness_losses[idx]
             loss_sorted_nodes = sorted(self._g.nodes, key=lambda x: x.loss)
             divider = int(percentile / 100 * len(loss_sorted_nodes))
             best_nodes = loss_sorted_nodes[:divider + 1]
         print('Found {} candidate handholds'.format(len(best_nodes)))
-        self.build_edges(best_nodes, 0.1)
+        if tree:
+            self._build_emst(best_nodes)
+        else:
+            self.build_edges(best_nodes, 0.1)
         return self.g
 
 
@@ -0,0 +1,110 @@
+# ALT (A*, landmarks, triangle inequality) heuristic for the handhold graph
+#
+# A handful of landmark nodes are picked spread out over the graph, and the
+# cost from every landmark to every node and from every node to every
+# landmark is stored. By the triangle inequality, for any landmark L
+#
+#   cost(v, t) >= cost(L, t) - cost(L, v)
+#   cost(v, t) >= cost(v, L) - cost(t, L)
+#
+# so the best of these over all landmarks is an admissible heuristic that
+# knows about the real loss weighted costs, unlike straight line distance.
+# Taking edges away (occupied nodes, the tether) only makes paths longer,
+# so it stays admissible under the A* constraints.
+#
+# Like the contraction hierarchy it's built over the edges a bot can hop,
+# for one hop distance, and kept as plain arrays for the cache.
+
+import numpy
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components, dijkstra
+
+
+class Landmarks:
+    def __init__(self, landmarks, forward, reverse, ids=None):
+        '''
+        forward[i, v] is the cost from landmarks[i] to v, reverse[i, v]
+        the cost from v to landmarks[i]. ids are the Node.IDs of the nodes.
+        '''
+        self.landmarks = numpy.asarray(landmarks)
+        self.forward = numpy.asarray(forward)
+        self.reverse = numpy.asarray(reverse)
+        self.ids = None if ids is None else numpy.asarray(ids)
+        self._position = None if ids is None else \
+            {ID: i for i, ID in enumerate(self.ids.tolist())}
+        # target -> heuristic of every node, a search only has one target
+        self._bounds = {}
+
+    @classmethod
+    def build(cls, edge_a, edge_b, weight, n: int, count: int=16, ids=None):
+        '''
+        Pick count landmarks by farthest point selection over a graph of n
+        nodes with directed edges edge_a -> edge_b, and work out their tables
+        '''
+        edge_a = numpy.asarray(edge_a, dtype=numpy.int64)
+        edge_b = numpy.asarray(edge_b, dtype=numpy.int64)
+        # csgraph treats 0 as no edge
+        weight = numpy.maximum(numpy.asarray(weight, dtype=numpy.float64),
+                               numpy.finfo(numpy.float64).tiny)
+        graph = csr_matrix((weight, (edge_a, edge_b)), shape=(n, n))
+        backward = graph.T.tocsr()
+
+        # Landmarks all go in the biggest component, the rest of the
+        # graph is a few stragglers that won't have a path to anything
+        _, labels = connected_components(graph, directed=False)
+        seed = int(numpy.argmax(labels == numpy.bincount(labels).argmax()))
+        spread = numpy.full(n, numpy.inf)
+        spread[labels != labels[seed]] = -1
+        # the first landmark is the node farthest from the seed
+        round_trip = dijkstra(graph, indices=seed) + dijkstra(backward, indices=seed)
+        candidate = int(numpy.argmax(numpy.where(numpy.isfinite(round_trip), round_trip, -1)))
+
+        landmarks, forward, reverse = [], [], []
+        for _ in range(min(count, n)):
+            landmarks.append(candidate)
+            forward.append(dijkstra(graph, indices=candidate))
+            reverse.append(dijkstra(backward, indices=candidate))
+            # next is the node farthest (there and back) from every landmark
+            round_trip = forward[-1] + reverse[-1]
+            spread = numpy.minimum(
+                spread, numpy.where(numpy.isfinite(round_trip), round_trip, -1))
+            spread[landmarks] = -1
+            candidate = int(numpy.argmax(spread))
+            if spread[candidate] <= 0:
+                break
+        return cls(numpy.array(landmarks, dtype=numpy.int64),
+                   numpy.array(forward), numpy.array(reverse), ids)
+
+    def to_arrays(self) -> dict:
+        arrays = {'landmarks': self.landmarks, 'forward': self.forward,
+                  'reverse': self.reverse}
+        if self.ids is not None:
+            arrays['ids'] = self.ids
+        return arrays
+
+    def bounds(self, t: int) -> numpy.ndarray:
+        '''Lower bound on the cost from every node to node t'''
+        if t not in self._bounds:
+            with numpy.errstate(invalid='ignore'):
+                # inf - inf is nan, which tells us nothing
+                via_fwd = numpy.nan_to_num(
+                    self.forward[:, t, None] - self.forward, nan=0, posinf=numpy.inf)
+                via_rev = numpy.nan_to_num(
+                    self.reverse - self.reverse[:, t, None], nan=0, posinf=numpy.inf)
+            bound = numpy.maximum(via_fwd.max(axis=0), via_rev.max(axis=0))
+            self._bounds[t] = numpy.maximum(bound, 0).tolist()
+        return self._bounds[t]
+
+    def heuristic(self, fallback=None):
+        '''
+        heuristic(u, v) on Nodes for bounded_leg_astar. Takes the max with
+        fallback(u, v) if that's another admissible heuristic.
+        '''
+        def h(u, v):
+            i = self._position.get(u.ID)
+            t = self._position.get(v.ID)
+            bound = 0 if i is None or t is None else self.bounds(t)[i]
+            if fallback is not None:
+                bound = max(bound, fallback(u, v))
+            return bound
+        return h
@@ -0,0 +1,147 @@
+# Array backed mesh graph
+#
+# Vertices are an (n, 3) float array, edges are deduplicated from the face
+# array in one go, and adjacency is stored as CSR (indptr/indices), with the
+# euclidean length of every adjacency entry in dist. Vertex i is node i,
+# which is also graph_constructor.Node.ID.
+#
+# Edges are numbered in the order the old networkx generate_graph added
+# them (every side of every face, in file order) and each vertex's
+# neighbours are kept in that order. The Planar gradient loss depends on
+# neighbour order, so this keeps the handholds the same as they were.
+#
+# to_networkx() builds the old Node/nx.Graph representation for code that
+# hasn't moved over yet.
+
+import numpy
+import plyfile
+import networkx as nx
+
+
+class MeshGraph:
+    def __init__(self, vertices, indptr, indices, dist, edge):
+        self.vertices = vertices
+        self.indptr = indptr
+        self.indices = indices
+        self.dist = dist
+        # which undirected edge each adjacency entry is, in the order added
+        self.edge = edge
+
+    @classmethod
+    def from_ply(cls, path: str):
+        '''Read a mesh polygon file'''
+        p = plyfile.PlyData.read(path)
+        v = p['vertex']
+        vertices = numpy.stack([v['x'], v['y'], v['z']], axis=1).astype(numpy.float64)
+        faces = p['face']['vertex_indices']
+        return cls.from_faces(vertices, faces)
+
+    @classmethod
+    def from_faces(cls, vertices: numpy.ndarray, faces):
+        '''
+        Build from vertices and faces. faces is an (m, k) array, or a
+        sequence of per face index arrays if the faces aren't all the
+        same size.
+        '''
+        n = len(vertices)
+        # (face numbers, faces) with all faces of a group the same size
+        if isinstance(faces, numpy.ndarray) and faces.dtype != object:
+            groups = [(numpy.arange(len(faces)), faces)]
+        elif len(set(map(len, faces))) == 1:
+            groups = [(numpy.arange(len(faces)), numpy.vstack(faces))]
+        else:
+            by_size = {}
+            for i, face in enumerate(faces):
+                by_size.setdefault(len(face), []).append(i)
+            groups = [(numpy.array(ids), numpy.array([faces[i] for i in ids]))
+                      for ids in by_size.values()]
+        size = max([f.shape[1] for _, f in groups if len(f)] + [1])
+
+        # Every side of every face. A side is ranked by its face, then by
+        # its (first, second) corner of the face, which is the order the
+        # old code added them to networkx in
+        low, high, rank = [], [], []
+        for ids, f in groups:
+            if not len(f):
+                continue
+            k = f.shape[1]
+            for p in range(k):
+                q = (p + 1) % k
+                first, second = min(p, q), max(p, q)
+                low.append(f[:, p])
+                high.append(f[:, q])
+                rank.append((ids * size + first) * size + second)
+        empty = [numpy.empty(0, dtype=numpy.int64)]
+        a = numpy.concatenate(low + empty).astype(numpy.int64)
+        b = numpy.concatenate(high + empty).astype(numpy.int64)
+        rank = numpy.concatenate(rank + empty)
+        # undirected, so dedup on (low, high) keeping the first time it's seen
+        low, high = numpy.minimum(a, b), numpy.maximum(a, b)
+        keys = low * n + high
+        order = numpy.lexsort((rank, keys))
+        keys, rank = keys[order], rank[order]
+        first = numpy.ones(len(keys), dtype=bool)
+        first[1:] = keys[1:] != keys[:-1]
+        keys, rank = keys[first], rank[first]
+        keys = keys[numpy.argsort(rank, kind='stable')]
+        low, high = keys // n, keys % n
+        low, high = low[low != high], high[low != high]
+        return cls.from_edges(vertices, low, high)
+
+    @classmethod
+    def from_edges(cls, vertices: numpy.ndarray, a: numpy.ndarray, b: numpy.ndarray):
+        '''
+        Build from unique undirected edges a[i] - b[i]. Like networkx, each
+        vertex's neighbours are in the order its edges were given in.
+        '''
+        n = len(vertices)
+        src = numpy.concatenate([a, b]).astype(numpy.int64)
+        dst = numpy.concatenate([b, a]).astype(numpy.int64)
+        edge = numpy.concatenate([numpy.arange(len(a)), numpy.arange(len(a))])
+        order = numpy.lexsort((edge, src))
+        src, dst, edge = src[order], dst[order], edge[order]
+        indptr = numpy.zeros(n + 1, dtype=numpy.int64)
+        numpy.cumsum(numpy.bincount(src, minlength=n), out=indptr[1:])
+        dist = numpy.linalg.norm(vertices[src] - vertices[dst], axis=1)
+        return cls(vertices, indptr, dst, dist, edge)
+
+    def number_of_nodes(self) -> int:
+        return len(self.vertices)
+
+    def number_of_edges(self) -> int:
+        return len(self.indices) // 2
+
+    def neighbors(self, i: int) -> numpy.ndarray:
+        return self.indices[self.indptr[i]:self.indptr[i + 1]]
+
+    def degree(self) -> numpy.ndarray:
+        return numpy.diff(self.indptr)
+
+    def sources(self) -> numpy.ndarray:
+        '''Source vertex of every adjacency entry'''
+        return numpy.repeat(numpy.arange(len(self.vertices)), self.degree())
+
+    def edges(self):
+        '''Unique undirected edges as (a, b, dist) arrays with a < b, in the order added'''
+        src = self.sources()
+        keep = numpy.flatnonzero(src < self.indices)
+        keep = keep[numpy.argsort(self.edge[keep], kind='stable')]
+        return src[keep], self.indices[keep], self.dist[keep]
+
+    def to_networkx(self, nodes=None) -> nx.Graph:
+        '''
+        Old style graph of graph_constructor.Node objects with a dist
+        attribute on each edge. nodes can be given to reuse existing Node
+        objects, one per vertex.
+        '''
+        # Avoid the circular import, graph_constructor builds on us
+        from graph_constructor import Node
+        if nodes is None:
+            nodes = [Node(i, v) for i, v in enumerate(self.vertices.tolist())]
+        G = nx.Graph()
+        G.add_nodes_from(nodes)
+        a, b, dist = self.edges()
+        G.add_edges_from(
+            (nodes[i], nodes[j], {'dist': d})
+            for i, j, d in zip(a.tolist(), b.tolist(), dist.tolist()))
+        return G
@@ -0,0 +1,143 @@
+# Batched neighbourhood queries over mesh vertices
+#
+# Finding the neighbourhood of every vertex one at a time with
+# nx.ego_graph is a full bounded Dijkstra plus a subgraph per vertex. This
+# does all vertices at once and returns the result as CSR style neighbour
+# lists: the neighbours of vertex i are idx[offsets[i]:offsets[i + 1]].
+#
+#   euclidean: everything within radius in a straight line, from a KD-tree
+#   geodesic:  everything within radius along mesh edges, from one multi
+#              source traversal over the CSR adjacency of a MeshGraph
+
+import numpy
+from scipy.spatial import cKDTree
+
+
+def _expand(indptr: numpy.ndarray, nodes: numpy.ndarray):
+    '''
+    Positions in a CSR indices array of every neighbour of nodes, and which
+    entry of nodes each one belongs to
+    '''
+    counts = indptr[nodes + 1] - indptr[nodes]
+    owner = numpy.repeat(numpy.arange(len(nodes)), counts)
+    starts = numpy.repeat(indptr[nodes] - (numpy.cumsum(counts) - counts), counts)
+    return starts + numpy.arange(counts.sum()), owner
+
+
+class Neighborhoods:
+    def __init__(self, offsets: numpy.ndarray, idx: numpy.ndarray, dist=None):
+        self.offsets = offsets
+        self.idx = idx
+        # distance to each neighbour, if known
+        self.dist = dist
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> numpy.ndarray:
+        return self.idx[self.offsets[i]:self.offsets[i + 1]]
+
+    def sizes(self) -> numpy.ndarray:
+        return numpy.diff(self.offsets)
+
+    def owners(self) -> numpy.ndarray:
+        '''Which vertex each entry of idx is a neighbour of'''
+        return numpy.repeat(numpy.arange(len(self)), self.sizes())
+
+    @classmethod
+    def from_pairs(cls, n: int, src: numpy.ndarray, dst: numpy.ndarray, dist=None):
+        '''Group (src, dst) pairs by src'''
+        order = numpy.lexsort((dst, src))
+        offsets = numpy.zeros(n + 1, dtype=numpy.int64)
+        numpy.cumsum(numpy.bincount(src, minlength=n), out=offsets[1:])
+        return cls(offsets, dst[order], None if dist is None else dist[order])
+
+    @classmethod
+    def euclidean(cls, points: numpy.ndarray, radius: float, tree: cKDTree=None,
+                  include_self: bool=False, chunk: int=4096, rows: numpy.ndarray=None):
+        '''
+        Neighbours within radius of every point (or just of rows, indices
+        into points), by straight line distance. Done chunk points at a
+        time, a big mesh at a big radius has hundreds of millions of pairs
+        and they shouldn't all be in flight at once.
+        '''
+        tree = tree or cKDTree(points)
+        if rows is None:
+            rows = numpy.arange(len(points))
+        sizes, idxs, dists = [], [], []
+        for first in range(0, len(rows), chunk):
+            block = rows[first:first + chunk]
+            # tree against tree keeps the whole query in C, query_ball_point
+            # would hand back a python list per point
+            pairs = cKDTree(points[block]).sparse_distance_matrix(
+                tree, radius, output_type='ndarray')
+            owner, idx, dist = pairs['i'], pairs['j'], pairs['v']
+            keep = idx != block[owner]
+            owner, idx, dist = owner[keep], idx[keep], dist[keep]
+            if include_self:
+                owner = numpy.concatenate([owner, numpy.arange(len(block))])
+                idx = numpy.concatenate([idx, block])
+                dist = numpy.concatenate([dist, numpy.zeros(len(block))])
+            order = numpy.lexsort((idx, owner))
+            sizes.append(numpy.bincount(owner, minlength=len(block)))
+            idxs.append(idx[order])
+            dists.append(dist[order])
+        offsets = numpy.zeros(len(rows) + 1, dtype=numpy.int64)
+        if len(rows):
+            numpy.cumsum(numpy.concatenate(sizes), out=offsets[1:])
+        return cls(offsets,
+                   numpy.concatenate(idxs) if idxs else numpy.empty(0, dtype=numpy.int64),
+                   numpy.concatenate(dists) if dists else numpy.empty(0))
+
+    @classmethod
+    def geodesic(cls, graph, radius: float, chunk: int=4096,
+                 include_self: bool=False):
+        '''
+        Neighbours within radius of every vertex of a mesh_graph.MeshGraph,
+        by shortest path along edges. All sources in a chunk are expanded
+        together, one hop per round, keeping the best distance per
+        (source, vertex) pair until nothing improves.
+        '''
+        n = graph.number_of_nodes()
+        srcs, dsts, dists = [], [], []
+        for first in range(0, n, chunk):
+            sources = numpy.arange(first, min(first + chunk, n))
+            # best known (source, vertex) -> dist, keyed by source * n + vertex
+            best_keys = sources * n + sources
+            best_dist = numpy.zeros(len(sources))
+            f_src, f_node, f_dist = sources, sources, numpy.zeros(len(sources))
+            while len(f_node):
+                entries, owner = _expand(graph.indptr, f_node)
+                src = f_src[owner]
+                node = graph.indices[entries]
+                d = f_dist[owner] + graph.dist[entries]
+                near = d <= radius
+                src, node, d = src[near], node[near], d[near]
+                keys = src * n + node
+                # shortest per pair this round
+                order = numpy.lexsort((d, keys))
+                keys, d = keys[order], d[order]
+                first_of = numpy.ones(len(keys), dtype=bool)
+                first_of[1:] = keys[1:] != keys[:-1]
+                keys, d = keys[first_of], d[first_of]
+                # only keep the ones that beat what we had
+                pos = numpy.searchsorted(best_keys, keys)
+                pos_c = numpy.minimum(pos, len(best_keys) - 1)
+                known = best_keys[pos_c] == keys
+                better = ~known | (d < best_dist[pos_c])
+                keys, d = keys[better], d[better]
+                # merge into best, new distances win
+                merged_keys = numpy.concatenate([keys, best_keys])
+                merged_dist = numpy.concatenate([d, best_dist])
+                best_keys, winner = numpy.unique(merged_keys, return_index=True)
+                best_dist = merged_dist[winner]
+                f_src, f_node, f_dist = keys // n, keys % n, d
+            src, dst = best_keys // n, best_keys % n
+            if not include_self:
+                keep = src != dst
+                src, dst, best_dist = src[keep], dst[keep], best_dist[keep]
+            srcs.append(src)
+            dsts.append(dst)
+            dists.append(best_dist)
+        return cls.from_pairs(n, numpy.concatenate(srcs), numpy.concatenate(dsts),
+                              numpy.concatenate(dists))
@@ -0,0 +1,46 @@
+# Find graph nodes by their coordinates
+#
+# networkx doesn't let us overload __eq__ on nodes, so positions from a
+# config (start and goal positions) have to be snapped to actual nodes.
+# This keeps a KD-tree over the node coords so each lookup is a nearest
+# neighbour query instead of a walk over every node.
+
+import numpy
+from scipy.spatial import cKDTree
+
+
+class NodeNotFound(LookupError):
+    pass
+
+
+class NodeIndex:
+    def __init__(self, nodes, tolerance: float=1.0):
+        '''
+        Index over nodes (anything with x, y, z). A position snaps to the
+        nearest node, if it's no further than tolerance away.
+        '''
+        self.nodes = list(nodes)
+        self.tolerance = tolerance
+        points = numpy.array([(n.x, n.y, n.z) for n in self.nodes]).reshape(-1, 3)
+        self._tree = cKDTree(points)
+
+    def query_many(self, positions, tolerance: float=None):
+        '''
+        Snap each of positions to its nearest node. Returns a list of
+        (node, distance), raises NodeNotFound if any position has no node
+        within tolerance.
+        '''
+        tolerance = self.tolerance if tolerance is None else tolerance
+        positions = numpy.asarray(positions, dtype=numpy.float64).reshape(-1, 3)
+        if not self.nodes:
+            raise NodeNotFound('No nodes to snap {} to'.format(positions.tolist()))
+        dist, idx = self._tree.query(positions)
+        missing = dist > tolerance
+        if missing.any():
+            raise NodeNotFound('No node within {} of {}, closest are {} away'.format(
+                tolerance, positions[missing].tolist(), dist[missing].tolist()))
+        return [(self.nodes[i], d) for i, d in zip(idx.tolist(), dist.tolist())]
+
+    def query(self, pos, tolerance: float=None):
+        '''Snap one position, returns (node, distance)'''
+        return self.query_many([pos], tolerance)[0]
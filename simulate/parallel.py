@@ -0,0 +1,115 @@
+# Chunked parallel scoring over shared memory
+#
+# The arrays a scoring function needs (vertices, adjacency, ...) are copied
+# into shared memory once. Workers attach to them when they start, so a task
+# is just (lo, hi): a contiguous block of vertex ids. Each worker writes its
+# results straight into a shared output array at [lo:hi], so nothing that
+# scales with the mesh goes through a pipe and results never depend on the
+# order tasks finish in.
+#
+#   out = parallel.map_chunks(score, {'points': points}, len(points))
+#
+# score(arrays, local, lo, hi, *args) must be a module level function (so it
+# can be pickled) and return the values for rows lo..hi. local is a dict
+# private to the worker, for things like a KD-tree that are worth building
+# once per worker rather than once per chunk.
+
+import multiprocessing
+import os
+from multiprocessing import shared_memory
+
+import numpy
+
+
+class SharedArrays:
+    '''A dict of numpy arrays living in shared memory'''
+
+    def __init__(self, arrays: dict):
+        self._shm = {}
+        # what a worker needs to attach: name -> (segment, shape, dtype)
+        self.spec = {}
+        for name, array in arrays.items():
+            array = numpy.ascontiguousarray(array)
+            # zero size segments aren't allowed
+            shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            numpy.ndarray(array.shape, array.dtype, shm.buf)[...] = array
+            self._shm[name] = shm
+            self.spec[name] = (shm.name, array.shape, array.dtype.str)
+
+    @staticmethod
+    def attach(spec: dict):
+        '''Views of the arrays in spec, and the segments keeping them alive'''
+        segments, arrays = [], {}
+        for name, (segment, shape, dtype) in spec.items():
+            shm = shared_memory.SharedMemory(name=segment)
+            segments.append(shm)
+            arrays[name] = numpy.ndarray(shape, dtype, shm.buf)
+        return arrays, segments
+
+    def get(self, name: str) -> numpy.ndarray:
+        shm = self._shm[name]
+        _, shape, dtype = self.spec[name]
+        return numpy.ndarray(shape, dtype, shm.buf)
+
+    def close(self):
+        for shm in self._shm.values():
+            shm.close()
+            shm.unlink()
+        self._shm = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# Per worker state, set up by _init
+_arrays = None
+_segments = None
+_local = None
+
+
+def _init(spec):
+    global _arrays, _segments, _local
+    _arrays, _segments = SharedArrays.attach(spec)
+    _local = {}
+
+
+def _run(task):
+    func, lo, hi, args = task
+    _arrays['out'][lo:hi] = func(_arrays, _local, lo, hi, *args)
+    return hi - lo
+
+
+def map_chunks(func, arrays: dict, n: int, args=(), processes: int=None,
+               chunk: int=1024, dtype=numpy.float64, progress: bool=True) -> numpy.ndarray:
+    '''
+    Run func over rows 0..n in chunks of chunk rows, across processes
+    workers (default one per core). Returns the n results as an array.
+    '''
+    processes = processes or os.cpu_count()
+    bounds = [(lo, min(lo + chunk, n)) for lo in range(0, n, chunk)]
+    done = 0
+
+    def report(count):
+        nonlocal done
+        done += count
+        if progress:
+            print('{:.2f}%'.format(100 * done / max(n, 1)), end='\r')
+
+    if processes == 1:
+        # Not worth the copy, just run it here
+        out = numpy.empty(n, dtype=dtype)
+        local = {}
+        for lo, hi in bounds:
+            out[lo:hi] = func(arrays, local, lo, hi, *args)
+            report(hi - lo)
+        return out
+
+    with SharedArrays(dict(arrays, out=numpy.empty(n, dtype=dtype))) as shared:
+        with multiprocessing.Pool(processes, _init, (shared.spec,)) as p:
+            tasks = [(func, lo, hi, args) for lo, hi in bounds]
+            for count in p.imap_unordered(_run, tasks):
+                report(count)
+        return shared.get('out').copy()
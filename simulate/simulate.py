@@ -5,18 +5,41 @@
 # Run with $ TEST=true ./simulate
 # to run used reduced data, so it doesn't take an hour
 # and OOM your machine
+# Graphs and handholds are cached in data/cache, and rebuilt automatically
+# when the mesh or code changes. GRAPH=true or HOLDS=true force a rebuild.
+# TREE=true links the handholds by their minimum spanning tree (under
+# compute_cost) instead of each one's nearest neighbours.
+# PLANNER=field shares one goal rooted cost to go field between all bots
+# instead of an A* per bot per turn. PLANNER=ch answers each move from a
+# contraction hierarchy (cached with the handholds), and only falls back to
+# A* when another bot or the tether is in the way. PLANNER=cooperative
+# plans every bot's next few moves together against a space-time
+# reservation table. PLANNER=alt is A* with a landmark heuristic (cached
+# with the handholds) instead of straight line distance.
 
 import networkx as nx
 import graph_constructor
+import graph_utils
 import handhold_detectors
+import mesh_graph
+import neighborhoods
+import compute_path
+import contraction
+import flatness
+import landmarks
+import parallel
 import os
 import itertools
-import pickle
 import math
-import matplotlib
+import time
 
+from cache import Cache
+from contraction import ContractionHierarchy
+from landmarks import Landmarks
 from compute_path import bounded_leg_astar
-from graph_utils import compute_cost, euclidean_distance, euclidean_distance_c
+from graph_utils import compute_cost, euclidean_distance, euclidean_distance_c, MAX_HOP_DISTANCE
+from mesh_graph import MeshGraph
+from node_index import NodeIndex
 
 class Found(Exception): pass
 
@@ -25,6 +48,18 @@ TEST = os.getenv('TEST')
 REGEN_GRAPH = os.getenv('GRAPH')
 REGEN_HOLDS = os.getenv('HOLDS')
 ITOKAWA = os.getenv('ITOKAWA')
+PLANNER = os.getenv('PLANNER', 'astar')
+CACHE = Cache(DATA_DIR + 'cache')
+# Handhold detector and its get_graph kwargs, part of the cache key
+HOLD_DETECTOR = 'Planar'
+HOLD_PARAMS = {'percentile': 25, 'tree': bool(os.getenv('TREE'))}
+# Everything the handholds are computed with, part of the cache key
+HOLD_MODULES = [mesh_graph, graph_constructor, handhold_detectors, graph_utils,
+                flatness, neighborhoods, parallel]
+# How far a configured start/goal position can be from its handhold
+SNAP_TOLERANCE = 1.0
+# Furthest a bot can be from the hub of the others
+TETHER_DISTANCE = 250
 
 if TEST:
     mesh = DATA_DIR + 'mesh1-superdecimated.ply'
@@ -35,23 +70,98 @@ else:
 
 print('Loading mesh {}...'.format(mesh))
 
-def get_node(h, pos):
-    '''Given node coords in h, return corresponding node in h.
-    This is due to network not allowing the overloading of
-    the __eq__ method for nodes
+# These look like good node positions
+START_NODE_POS = [
+    # planar
+    (362.98, -747.74, -33.73),
+    (365.12, -747.02, -34.31),
+    (355.47, -732.96, -31.34),
+    (370.75, -724.73, -32.03)
+    # Old
+#    (-249.14, 27.9, -34.4),
+#    (543.18, -696.065, -28.9262),
+#    (518.1, -687.459, -23.527),
+#    (524.652, -667.315, -20.868),
+#    (550.481, -675.239, -23.726)
+]
+END_NODE_POS = (-139.15, 877.49, 212.1)
+# old
+#END_NODE_POS = (-63.16, -427.12, 69.33)
+
+if ITOKAWA:
+    START_NODE_POS = [
+        # MAXIMA
+        #(-87.43, 50.58, 111.15),
+        #(-90.38, 41, 108.55),
+        #(-81.549, 39.78, 110.72),
+        #(-70.25, 62.9, 106.7),
+        # PLANAR
+        (-159.38, -119.26, 15.17),
+        (-162.14, -118.72, 14.44),
+        (-162.10, -118.41, 15.70),
+        (-159.33, -118.92, 16.42)
+
+    ]
+
+    # MAXIMA
+    #END_NODE_POS = (140.88, -22.55, 113.61)
+    # PLANAR
+    #END_NODE_POS = (94.06, 89.07, 74.53)
+    #END_NODE_POS = (-69.78, -7.15, -105.94)
+    # Works
+    #END_NODE_POS = (-161.405, -115.7, 25.83)
+    # Works
+    #END_NODE_POS = (-135.54, -56.34, 77.56)
+    END_NODE_POS = (-61.57, 21.41, 116.34)
+
+
+def make_planner(name, h, end_node):
+    '''
+    Returns step(bot, bots), which gives the next node for bot given the
+    other bots, or raises if bot can't move
     '''
+    def astar(bot, bots, heuristic=compute_cost):
+        return bounded_leg_astar(
+            h.g,
+            bot.node,
+            end_node,
+            heuristic=heuristic,
+            bots=bots
+        )[1]
 
-    for n in h:
-        if math.isclose(n.x, pos[0], rel_tol=0.01) and \
-                math.isclose(n.y, pos[1], rel_tol=0.01) and \
-                math.isclose(n.z, pos[2], rel_tol = 0.01):
-            return n
+    if name == 'astar':
+        return astar
+    if name == 'alt':
+        lm = load_landmarks(h)
+        # Only admissible for bots that can't hop further than the tables
+        alt = lm.heuristic(compute_cost)
 
-    print('Warning, node ', pos, ' not in h')
+        def step(bot, bots):
+            if bot.hop_distance <= MAX_HOP_DISTANCE:
+                return astar(bot, bots, alt)
+            return astar(bot, bots)
+        return step
+    if name == 'field':
+        return compute_path.CostToGo(h.g, end_node).next_hop
+    if name == 'ch':
+        ch = load_hierarchy(h)
+        nodes = {n.ID: n for n in h.g.nodes}
+
+        def step(bot, bots):
+            # The hierarchy only knows static costs for one hop distance
+            if bot.hop_distance == MAX_HOP_DISTANCE:
+                path = ch.node_path(bot.node, end_node, nodes)
+                if path and len(path) > 1 and compute_path.can_hop(bot, path[1], bots):
+                    return path[1]
+            return astar(bot, bots)
+        return step
+    if name == 'cooperative':
+        return compute_path.CooperativePlanner(h.g, end_node).next_hop
+    raise ValueError('Unknown planner {}'.format(name))
 
 
 class Bot:
-    def __init__(self, id, start, max_hop_distance=100, tether_distance=250):
+    def __init__(self, id, start, max_hop_distance=MAX_HOP_DISTANCE, tether_distance=TETHER_DISTANCE):
         self.id = id
         self.node = start
         self.hop_distance = max_hop_distance
@@ -61,164 +171,215 @@ class Bot:
         self.moved = True
 
 
-def write_graph():
-    '''Only call me if you generated a new mesh'''
+def load_graph(regen=False) -> MeshGraph:
+    '''
+    Mesh graph of the current mesh, from the cache unless the mesh or
+    graph code changed (or regen is set)
+    '''
+    key = CACHE.key(mesh, {'artifact': 'graph'}, [mesh_graph])
+    arrays = None if regen else CACHE.load(key)
+    if arrays is not None:
+        return MeshGraph(**arrays)
     print('Generating graph...')
-    g = graph_constructor.generate_graph(mesh)
-    nx.write_gpickle(g, '../data/graph.gpickle')
-    return g
+    m = MeshGraph.from_ply(mesh)
+    CACHE.save(key, {'mesh': mesh}, vertices=m.vertices, indptr=m.indptr,
+               indices=m.indices, dist=m.dist, edge=m.edge)
+    return m
 
-def write_handholds(g=None):
+
+def handhold_key(artifact='handholds', modules=(), **params):
+    '''Cache key of the handholds, or of something derived from them'''
+    return CACHE.key(
+        mesh,
+        dict(HOLD_PARAMS, artifact=artifact, detector=HOLD_DETECTOR, **params),
+        HOLD_MODULES + list(modules))
+
+
+def load_handholds(regen=False, regen_graph=False):
     '''
-    Only call me if you changed 
-    the handhold detector code
+    Handhold graph of the current mesh, from the cache unless the mesh,
+    detector parameters or detector code changed (or regen is set)
     '''
-    if not g:
-        g = nx.read_gpickle(DATA_DIR + 'graph.gpickle')
+    m = load_graph(regen_graph)
+    key = handhold_key()
+    detector = getattr(handhold_detectors, HOLD_DETECTOR)
+    arrays = None if regen or regen_graph else CACHE.load(key)
+    if arrays is not None:
+        return detector.from_arrays(m.vertices, **arrays)
     print('Searching for handholds...')
-    #h = handhold_detectors.Maxima(g)
-    h = handhold_detectors.Planar(g)
-    h.get_graph()
-    with open(DATA_DIR + 'handhold.pickle', 'wb+') as f:
-        pickle.dump(h, f)
+    h = detector(m.to_networkx())
+    h.get_graph(**HOLD_PARAMS)
+    CACHE.save(key, {'mesh': mesh, 'detector': HOLD_DETECTOR},
+               **h.to_arrays())
+    return h
+
 
-def multi_bot(bots=4, cache=True):
+def hop_edges(h, hop_distance):
     '''
-    Have multiple tethered robots attempt to get to
-    the goal node. Boths can't occupy the same space
-    at the same time, or stray more than
-    tether_distance from the other bots.help
+    Handhold nodes, and the edges between them a bot can hop as (a, b,
+    weight), with a and b indices into the nodes
     '''
-    print('Loading graph...')
-    g = nx.read_gpickle(DATA_DIR + 'graph.gpickle')
-    print('Loading handholds...')
-    with open(DATA_DIR + 'handhold.pickle', 'rb') as f:
-        h = pickle.load(f)
+    nodes = list(h.g.nodes)
+    position = {n: i for i, n in enumerate(nodes)}
+    edges = [(position[a], position[b], w['weight'])
+             for a, b, w in h.g.edges(data=True) if w['dist'] <= hop_distance]
+    a, b, weight = zip(*edges) if edges else ((), (), ())
+    return nodes, a, b, weight
 
-    ## Generate XYZ file for pics
-    with open(DATA_DIR + 'handholds.xyz', 'w') as f:
-        for n in h.g.nodes:
-            f.write('{} {} {}\n'.format(n.x, n.y, n.z))
 
-    # These look like good node positions
-    START_NODE_POS = [
-        # planar
-        (362.98, -747.74, -33.73),
-        (365.12, -747.02, -34.31),
-        (355.47, -732.96, -31.34),
-        (370.75, -724.73, -32.03)
-        # Old
-#        (-249.14, 27.9, -34.4),
-#        (543.18, -696.065, -28.9262),
-#        (518.1, -687.459, -23.527),
-#        (524.652, -667.315, -20.868),
-#        (550.481, -675.239, -23.726)
-    ]
-    END_NODE_POS = (-139.15, 877.49, 212.1)
-    # old
-    #END_NODE_POS = (-63.16, -427.12, 69.33)
-
-    if ITOKAWA:
-        START_NODE_POS = [
-            # MAXIMA
-            #(-87.43, 50.58, 111.15),
-            #(-90.38, 41, 108.55),
-            #(-81.549, 39.78, 110.72),
-            #(-70.25, 62.9, 106.7),
-            # PLANAR
-            (-159.38, -119.26, 15.17),
-            (-162.14, -118.72, 14.44),
-            (-162.10, -118.41, 15.70),
-            (-159.33, -118.92, 16.42)
-
-        ]
+def load_landmarks(h, hop_distance=MAX_HOP_DISTANCE, count=16, regen=False):
+    '''
+    ALT landmark tables of the handhold graph for bots that can hop
+    hop_distance, cached alongside the handholds
+    '''
+    key = handhold_key('landmarks', [landmarks], hop_distance=hop_distance,
+                       count=count)
+    arrays = None if regen else CACHE.load(key)
+    if arrays is not None:
+        return Landmarks(**arrays)
+    print('Picking landmarks...')
+    nodes, a, b, weight = hop_edges(h, hop_distance)
+    lm = Landmarks.build(a, b, weight, len(nodes), count, ids=[n.ID for n in nodes])
+    CACHE.save(key, {'mesh': mesh, 'hop_distance': hop_distance},
+               **lm.to_arrays())
+    return lm
 
-        # MAXIMA
-        #END_NODE_POS = (140.88, -22.55, 113.61)
-        # PLANAR
-        #END_NODE_POS = (94.06, 89.07, 74.53)
-        #END_NODE_POS = (-69.78, -7.15, -105.94)
-        # Works
-        #END_NODE_POS = (-161.405, -115.7, 25.83)
-        # Works
-        #END_NODE_POS = (-135.54, -56.34, 77.56)
-        END_NODE_POS = (-61.57, 21.41, 116.34)
 
+def load_hierarchy(h, hop_distance=MAX_HOP_DISTANCE, regen=False):
+    '''
+    Contraction hierarchy of the handhold graph for bots that can hop
+    hop_distance, cached alongside the handholds
+    '''
+    key = handhold_key('hierarchy', [contraction], hop_distance=hop_distance)
+    arrays = None if regen else CACHE.load(key)
+    if arrays is not None:
+        return ContractionHierarchy(**arrays)
+    print('Building contraction hierarchy...')
+    nodes, a, b, weight = hop_edges(h, hop_distance)
+    ch = ContractionHierarchy.build(a, b, weight, len(nodes),
+                                    ids=[n.ID for n in nodes])
+    CACHE.save(key, {'mesh': mesh, 'hop_distance': hop_distance},
+               **ch.to_arrays())
+    return ch
 
-    #sorted_nodes = sorted(h.g.nodes(), key=lambda n: n.x ** 2 + n.y ** 2 + n.z ** 2)
-    print(h.g.number_of_nodes())
-    print(h.g.number_of_edges())
-    start_nodes = [get_node(h.g, pos) for pos in START_NODE_POS]
-    #start_nodes = sorted_nodes[:4]
-    end_node = get_node(h.g, END_NODE_POS)
-    #end_node = sorted_nodes[250]
-    # Make sure that we actually find the nodes...
-    assert(any(start_nodes))
+
+def run_scenario(h, start_pos, end_pos, planner=PLANNER,
+                 hop_distance=MAX_HOP_DISTANCE, tether_distance=TETHER_DISTANCE,
+                 max_turns=None, verbose=True):
+    '''
+    Have multiple tethered robots, one per start position, attempt to get
+    to the goal node. Boths can't occupy the same space at the same time,
+    or stray more than tether_distance from the other bots. Returns the
+    bots and a dict of results: success, turns (rounds of every bot
+    taking a turn), total_dist (over all bots), runtime and error.
+    Raises if a position isn't a handhold, the planner is unknown or
+    hop_distance is over MAX_HOP_DISTANCE.
+    '''
+    started = time.perf_counter()
+    log = print if verbose else lambda *args, **kwargs: None
+    # The handhold graph has no edges longer than this, so a longer hop
+    # would quietly plan as if it was MAX_HOP_DISTANCE
+    if hop_distance > MAX_HOP_DISTANCE:
+        raise ValueError('hop_distance {} is over the {} the handholds were built for'.format(
+            hop_distance, MAX_HOP_DISTANCE))
+    # Snap the positions to handholds, this raises if any aren't found
+    index = NodeIndex(h.g.nodes, SNAP_TOLERANCE)
+    start_nodes = [n for n, _ in index.query_many(start_pos)]
+    end_node, _ = index.query(end_pos)
 
     # Run a simulation with bots tethered to each other
     # they can't occupy the same space, and cannot go further
     # than Bot.tether_length from the other bots
-    bots = [Bot(i, node) for i, node in enumerate(start_nodes)] 
+    bots = [Bot(i, node, hop_distance, tether_distance)
+            for i, node in enumerate(start_nodes)]
+    step = make_planner(planner, h, end_node)
     # init occupied nodes
     for b in bots:
         b.node.occupied = b
-    print('bots', [b.node for b in bots])
+    log('bots', [b.node for b in bots])
     turn = 0
+    rounds = 0
+    error = ''
     try:
         while True:
             if not any([b.moved for b in bots]):
                 raise Exception('No bots moved last turn')
+            if max_turns and rounds >= max_turns:
+                raise Exception('Gave up after {} turns'.format(rounds))
+            rounds += 1
             for bot in bots:
                 turn += 1
                 bot.path.append((turn, bot.node.x, bot.node.y, bot.node.z))
                 try:
-                    path_nodes = bounded_leg_astar(
-                        h.g, 
-                        bot.node, 
-                        end_node, 
-                        heuristic=compute_cost,
-                        bots=[b for b in bots if b.id != bot.id]
-                    )
+                    next_node = step(bot, [b for b in bots if b.id != bot.id])
                     bot.moved = True
                 except:
-                    print(bot.id, 'did not move') 
+                    log(bot.id, 'did not move')
                     bot.moved = False
                     bot.node.occupied = bot
                     continue
-                print('{}: {}: {} -> {}'.format(len(bot.path), bot.id, bot.node, path_nodes[1]))
+                log('{}: {}: {} -> {}'.format(len(bot.path), bot.id, bot.node, next_node))
                 bot.node.occupied = False
-                bot.total_dist += euclidean_distance(bot.node, path_nodes[1])
-                bot.node = path_nodes[1]
-                path_nodes[1].occupied = bot
-                if end_node.occupied: 
+                bot.total_dist += euclidean_distance(bot.node, next_node)
+                bot.node = next_node
+                next_node.occupied = bot
+                if end_node.occupied:
                     raise Found
     except Found:
-        print('Bot {} reached end node'.format(end_node.occupied.id))
-        print('final pos: ', [bot.node for bot in bots])
+        log('Bot {} reached end node'.format(end_node.occupied.id))
+        log('final pos: ', [bot.node for bot in bots])
         for n in h.g.nodes:
             if n.occupied:
-                print(n, 'is occupied')
+                log(n, 'is occupied')
         for bot in bots:
-            import compute_path
             x, y, z = compute_path.compute_hub_pos(bots)
-            print('bot {} is {} units away from hub'.format(
+            log('bot {} is {} units away from hub'.format(
                 bot.id, euclidean_distance_c(bot.node, (x, y, z))))
-        print('Saving paths...')
-        for bot in bots:
-            # Print stats
-            print('{} moved {} total distance units'.format(bot.id, bot.total_dist))
-            # Save paths for analysis
-            with open(DATA_DIR + 'bot{}-path'.format(bot.id), 'w+') as f:
-                for move in bot.path:
-                    f.write('{} {} {} {}\n'.format(bot.id, move[1], move[2], move[3]))
-            with open(DATA_DIR + 'bot{}-path.xyz'.format(bot.id), 'w+') as f:
-                for move in bot.path: 
-                    f.write('{} {} {}\n'.format(move[1], move[2], move[3]))
+    except Exception as e:
+        error = str(e)
+    finally:
+        # Leave the graph as we found it for the next scenario
+        for b in bots:
+            b.node.occupied = None
+    return bots, {
+        'success': not error,
+        'turns': rounds,
+        'total_dist': sum(b.total_dist for b in bots),
+        'runtime': time.perf_counter() - started,
+        'error': error,
+    }
+
+
+def multi_bot(bots=4, cache=True, planner=PLANNER):
+    '''
+    Run the default scenario for the current mesh with the first bots
+    start positions, and save the paths
+    '''
+    print('Loading handholds...')
+    h = load_handholds(REGEN_HOLDS, REGEN_GRAPH)
+
+    ## Generate XYZ file for pics
+    with open(DATA_DIR + 'handholds.xyz', 'w') as f:
+        for n in h.g.nodes:
+            f.write('{} {} {}\n'.format(n.x, n.y, n.z))
+
+    #sorted_nodes = sorted(h.g.nodes(), key=lambda n: n.x ** 2 + n.y ** 2 + n.z ** 2)
+    print(h.g.number_of_nodes())
+    print(h.g.number_of_edges())
+    bots, result = run_scenario(h, START_NODE_POS[:bots], END_NODE_POS, planner)
+    if not result['success']:
+        raise Exception(result['error'])
+    print('Saving paths...')
+    for bot in bots:
+        # Print stats
+        print('{} moved {} total distance units'.format(bot.id, bot.total_dist))
+        # Save paths for analysis
+        with open(DATA_DIR + 'bot{}-path'.format(bot.id), 'w+') as f:
+            for move in bot.path:
+                f.write('{} {} {} {}\n'.format(bot.id, move[1], move[2], move[3]))
+        with open(DATA_DIR + 'bot{}-path.xyz'.format(bot.id), 'w+') as f:
+            for move in bot.path:
+                f.write('{} {} {}\n'.format(move[1], move[2], move[3]))
 
 if __name__ == '__main__':
-    if REGEN_GRAPH:
-        g = write_graph()
-        write_handholds(g)
-    if not REGEN_GRAPH and REGEN_HOLDS:
-        write_handholds()
     multi_bot()
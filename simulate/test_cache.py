@@ -0,0 +1,37 @@
+# Cache keys of the simulation artifacts
+
+import shutil
+
+import pytest
+
+import compute_path
+import flatness
+import handhold_detectors
+import neighborhoods
+import parallel
+import simulate
+
+
+def edit(module, tmp_path, monkeypatch):
+    '''Point module at an edited copy of its source'''
+    edited = tmp_path / 'edited.py'
+    shutil.copy(module.__file__, edited)
+    with open(edited, 'a') as f:
+        f.write('\n# edited\n')
+    monkeypatch.setattr(module, '__file__', str(edited))
+
+
+@pytest.mark.parametrize('module', [handhold_detectors, flatness, neighborhoods, parallel])
+def test_editing_hold_code_changes_key(tmp_path, monkeypatch, module):
+    holds = simulate.handhold_key()
+    hierarchy = simulate.handhold_key('hierarchy', hop_distance=100)
+    edit(module, tmp_path, monkeypatch)
+    assert simulate.handhold_key() != holds
+    # anything built from the handholds goes stale with them
+    assert simulate.handhold_key('hierarchy', hop_distance=100) != hierarchy
+
+
+def test_editing_planner_code_keeps_key(tmp_path, monkeypatch):
+    holds = simulate.handhold_key()
+    edit(compute_path, tmp_path, monkeypatch)
+    assert simulate.handhold_key() == holds
@@ -0,0 +1,33 @@
+# Goal rooted cost to go field
+
+import random
+
+import networkx as nx
+import pytest
+
+from compute_path import CostToGo
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_repaired_field_matches_search_without_blocked(seed):
+    rng = random.Random(seed)
+    G = nx.gnm_random_graph(300, 1500, seed=seed, directed=True)
+    for u, v in G.edges:
+        # some free edges, csgraph mustn't lose them
+        G[u][v].update(dist=rng.random() * 2, weight=rng.choice([0, rng.random()]))
+    ctg = CostToGo(G, 0)
+    for _ in range(10):
+        blocked = frozenset(rng.sample(range(300), rng.randint(1, 20)))
+        H = nx.DiGraph()
+        H.add_nodes_from(n for n in G if n not in blocked)
+        H.add_edges_from((u, v, d) for u, v, d in G.edges(data=True)
+                         if d['dist'] <= 1.5 and u not in blocked and v not in blocked)
+        expected = nx.single_source_dijkstra_path_length(H.reverse(), 0) if 0 in H else {}
+        field = ctg.field(1.5, blocked)
+        assert field.keys() == expected.keys()
+        assert field == pytest.approx(expected)
+    # the unblocked field isn't touched by the repairs
+    assert ctg.field(1.5) == pytest.approx(nx.single_source_dijkstra_path_length(
+        G.edge_subgraph((u, v) for u, v, d in G.edges(data=True) if d['dist'] <= 1.5)
+        .reverse(), 0))
+    assert ctg.searches == 1
@@ -0,0 +1,42 @@
+# Contraction hierarchy queries
+
+import numpy
+import pytest
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+
+from cache import Cache
+from contraction import ContractionHierarchy
+
+
+@pytest.mark.parametrize('witness_limit, hop_limit, core_degree', [
+    (50, 5, 1000), (1, 1, 1000), (1000, 1000, 1000),
+    # most of it left in the core
+    (50, 5, 12), (50, 5, 0),
+])
+def test_queries_match_dijkstra(tmp_path, witness_limit, hop_limit, core_degree):
+    rng = numpy.random.default_rng(witness_limit + core_degree)
+    n = 150
+    a, b = rng.integers(0, n, (2, 4 * n))
+    weight = rng.random(4 * n) * 10 + 0.01
+    ch = ContractionHierarchy.build(a, b, weight, n, witness_limit=witness_limit,
+                                    hop_limit=hop_limit, core_degree=core_degree)
+    assert (ch.core < n) == (core_degree < 30)
+    # the cached form answers the same
+    cache = Cache(str(tmp_path))
+    cache.save('ch', **ch.to_arrays())
+    ch = ContractionHierarchy(**cache.load('ch'))
+
+    best = {}
+    for u, x, w in zip(a.tolist(), b.tolist(), weight.tolist()):
+        if u != x:
+            best[u, x] = min(w, best.get((u, x), numpy.inf))
+    u, x = zip(*best)
+    expected = dijkstra(csr_matrix((list(best.values()), (u, x)), shape=(n, n)))
+    for s in range(0, n, 7):
+        for t in range(n):
+            cost, path = ch.query(s, t)
+            assert cost == pytest.approx(expected[s, t])
+            if path is not None:
+                assert path[0] == s and path[-1] == t
+                assert sum(best[hop] for hop in zip(path, path[1:])) == pytest.approx(cost)
@@ -0,0 +1,46 @@
+# Handhold graph construction
+
+import os
+
+import numpy
+import pytest
+from scipy.sparse.csgraph import minimum_spanning_tree
+from scipy.spatial.distance import cdist
+
+from handhold_detectors import loss_mst_edges, Planar, RISK_WEIGHT
+from mesh_graph import MeshGraph
+
+MESH = os.path.join(os.path.dirname(__file__), '..', 'data', 'mesh1-superdecimated.ply')
+
+
+def cost(points, loss, a, b):
+    '''Undirected edge cost, the cheaper direction of compute_cost'''
+    return numpy.linalg.norm(points[a] - points[b], axis=-1) + \
+        RISK_WEIGHT * numpy.minimum(loss[a], loss[b])
+
+
+@pytest.mark.parametrize('max_loss', [0, 600, 3000])
+def test_loss_mst_matches_dense_mst(max_loss):
+    rng = numpy.random.default_rng(max_loss)
+    points = rng.random((1500, 3)) * 1000
+    # a few duplicates, zero length edges must still join the tree
+    points[:20] = points[20:40]
+    loss = rng.random(len(points)) * max_loss
+    dense = cdist(points, points) + RISK_WEIGHT * numpy.minimum(loss[:, None], loss)
+    # csgraph drops (near) zero entries from a dense matrix. Every spanning
+    # tree has n - 1 edges, so shift every cost by 1 and take it back off
+    dense += 1
+    numpy.fill_diagonal(dense, 0)
+    expected = minimum_spanning_tree(dense).sum() - (len(points) - 1)
+
+    a, b = loss_mst_edges(points, loss)
+    assert len(a) == len(points) - 1
+    assert cost(points, loss, a, b).sum() == pytest.approx(expected, rel=1e-12)
+
+
+@pytest.mark.parametrize('tree', [False, True])
+def test_planar_tree_flag_picks_edges(monkeypatch, tree):
+    monkeypatch.setattr(Planar, '_build_emst', lambda self, nodes: setattr(self, 'g', 'tree'))
+    monkeypatch.setattr(Planar, 'build_edges', lambda self, nodes, *args: setattr(self, 'g', 'knn'))
+    g = Planar(MeshGraph.from_ply(MESH).to_networkx()).get_graph(tree=tree)
+    assert g == ('tree' if tree else 'knn')
@@ -0,0 +1,40 @@
+# Array backed mesh graph
+
+import itertools
+import os
+
+import networkx as nx
+import numpy
+import plyfile
+
+from mesh_graph import MeshGraph
+
+MESH = os.path.join(os.path.dirname(__file__), '..', 'data', 'mesh1-superdecimated.ply')
+
+
+def reference_graph(n, faces):
+    '''How generate_graph used to build the graph, straight into networkx'''
+    G = nx.Graph()
+    G.add_nodes_from(range(n))
+    for face in faces:
+        G.add_edges_from(itertools.permutations([int(i) for i in face], 2))
+    return G
+
+
+def test_neighbour_order_matches_networkx():
+    vertices = numpy.random.default_rng(0).random((6, 3))
+    faces = numpy.array([[4, 2, 0], [0, 2, 5], [1, 3, 4], [5, 4, 2]])
+    m = MeshGraph.from_faces(vertices, faces)
+    G = reference_graph(len(vertices), faces)
+    assert [m.neighbors(u).tolist() for u in G] == [list(G[u]) for u in G]
+
+
+def test_mesh_neighbour_order_matches_networkx():
+    p = plyfile.PlyData.read(MESH)
+    G = reference_graph(len(p['vertex']), p['face']['vertex_indices'])
+    m = MeshGraph.from_ply(MESH)
+    H = m.to_networkx()
+    assert m.number_of_edges() == G.number_of_edges()
+    for u, node in zip(G, H):
+        assert m.neighbors(u).tolist() == list(G[u])
+        assert [v.ID for v in H[node]] == list(G[u])
@@ -0,0 +1,48 @@
+# Adaptive sweeps against the replay backend
+
+import pytest
+
+import adaptive
+import controller
+import replay
+import scan
+from servo import Servo
+
+
+class RecordingPi(replay.ReplayPi):
+    '''ReplayPi that remembers every pulse width it was told to go to'''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.history = []
+
+    def set_servo_pulsewidth(self, pin: int, pw: float) -> None:
+        self.history.append(pw)
+        super().set_servo_pulsewidth(pin, pw)
+
+
+@pytest.mark.parametrize('budget', [{}, {'point_budget': 5000}])
+@pytest.mark.parametrize('pipelined', [False, True])
+def test_sweep_stays_in_servo_range(tmp_path, monkeypatch, budget, pipelined):
+    monkeypatch.setattr(scan.Lidar, 'DATA_PATH', str(tmp_path))
+    rig = replay.ReplayRig(scan_period=0.002, settle_time=0, open_time=0)
+    rig.pi = RecordingPi(settle_time=0, latency=0)
+    lidar = scan.Lidar(backend=rig, pi=rig.pi,
+                       settle_time=controller.SettleTime(0, 0))
+    try:
+        lidar.scan(pipelined=pipelined, stepper=adaptive.AdaptiveStepper(**budget),
+                   draw_preview=False)
+    finally:
+        lidar.close()
+    assert lidar.writer.n_slices > 1
+    assert max(rig.pi.history) <= Servo.MAX
+    # and it got to the end of the sweep before resetting
+    assert Servo.pw_to_deg(rig.pi.history[-2]) >= scan.Lidar.MAX_PHI
+
+
+def test_last_step_is_clamped():
+    stepper = adaptive.AdaptiveStepper(point_budget=10)
+    ranges = [3000] * 100
+    stepper.next_step(ranges, 0)
+    assert stepper.next_step(ranges, 86.5) == 3
+    assert stepper.next_step(ranges, 88.5) == 1
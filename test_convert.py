@@ -0,0 +1,41 @@
+# Scan conversion
+
+import os
+import pickle
+
+import pytest
+
+import convert
+import scanfile
+
+
+def write_scan(path):
+    with scanfile.ScanWriter(str(path), theta_step=0.35, phi0=0, sync=False) as w:
+        w.append([100, 200, 300], 0)
+        w.append([100, 200, 300], 1)
+
+
+def test_bad_files_are_rejected(tmp_path):
+    empty = tmp_path / 'scan-1.lscan'
+    empty.write_bytes(b'')
+    garbage = tmp_path / 'scan-2.lscan'
+    garbage.write_bytes(b'not a scan at all, but long enough for a header' * 2)
+    truncated = tmp_path / 'scan-3'
+    truncated.write_bytes(pickle.dumps([(1, 2, 3)] * 100)[:50])
+    other = tmp_path / 'notes.txt'
+    other.write_text('hello')
+    for path in (empty, garbage, truncated, other):
+        with pytest.raises(ValueError):
+            convert.load_chunks(str(path))
+
+
+def test_convert_dir_skips_bad_scans(tmp_path):
+    write_scan(tmp_path / 'scan-1.lscan')
+    (tmp_path / 'scan-2.lscan').write_bytes(b'')
+    (tmp_path / 'scan-3').write_bytes(pickle.dumps([(1, 2, 3)] * 100)[:50])
+    with open(tmp_path / 'scan-4', 'wb') as f:
+        pickle.dump([(1, 2, 3), (4, 5, 6)], f)
+    outputs = convert.convert_dir(str(tmp_path), 'xyz', processes=2)
+    assert sorted(map(os.path.basename, outputs)) == ['scan-1.lscan.xyz', 'scan-4.xyz']
+    with open(tmp_path / 'scan-4.xyz') as f:
+        assert f.read() == '1.00 2.00 3.00\n4.00 5.00 6.00\n'
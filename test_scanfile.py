@@ -0,0 +1,20 @@
+# Scan file writing
+
+import scanfile
+
+
+def test_empty_scan_is_removed(tmp_path):
+    path = str(tmp_path / 'scan-1.lscan')
+    scanfile.ScanWriter(path, theta_step=0.35, phi0=0).close()
+    assert not (tmp_path / 'scan-1.lscan').exists()
+
+
+def test_scan_round_trip(tmp_path):
+    path = str(tmp_path / 'scan-1.lscan')
+    with scanfile.ScanWriter(path, theta_step=0.35, phi0=0, sync=False) as w:
+        w.append([100, 10, 300], 0)
+        w.append([200, 400, 0], 1)
+    scan = scanfile.ScanFile(path)
+    assert len(scan) == 2
+    assert scan.ranges.tolist() == [[100, 10, 300], [200, 400, 0]]
+    assert scan.phi.tolist() == [0, 1]
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+
+# Streaming voxel grid downsampling and outlier rejection
+#
+# Points are merged into a voxel hash grid as slices arrive, each voxel
+# keeps the sum and count of the points that fell in it, so memory is
+# bounded by the number of occupied voxels no matter how long the sweep is.
+# Voxels with too few points around them (isolated spurious returns) are
+# dropped when the filtered cloud is read out.
+
+import itertools
+import math
+
+import numpy
+
+# Voxel coords are packed into one int64 key, 21 bits per axis
+_BITS = 21
+_OFFSET = 1 << (_BITS - 1)
+
+
+def pack_voxels(ijk: numpy.ndarray) -> numpy.ndarray:
+    '''Pack (n, 3) integer voxel coords into one int64 key each'''
+    ijk = ijk.astype(numpy.int64) + _OFFSET
+    return (ijk[:, 0] << (2 * _BITS)) | (ijk[:, 1] << _BITS) | ijk[:, 2]
+
+
+def _offset_key(di: int, dj: int, dk: int) -> int:
+    '''What to add to a packed key to move by (di, dj, dk) voxels'''
+    return (di << (2 * _BITS)) + (dj << _BITS) + dk
+
+
+class VoxelFilter:
+    '''
+    voxel_size is in mm. A voxel is an outlier if there are fewer than
+    min_neighbors other points within radius mm of it (counted at voxel
+    resolution). min_neighbors=0 turns outlier rejection off.
+    '''
+
+    def __init__(self, voxel_size: float=20, radius: float=None,
+                 min_neighbors: int=3):
+        self.voxel_size = voxel_size
+        self.radius = radius or voxel_size
+        self.min_neighbors = min_neighbors
+        self._offsets = self._neighbor_offsets()
+        self.reset()
+
+    def reset(self) -> None:
+        '''Empty the grid, call at the start of a sweep'''
+        self.keys = numpy.empty(0, dtype=numpy.int64)
+        self.sums = numpy.empty((0, 3))
+        self.counts = numpy.empty(0, dtype=numpy.int64)
+        self.n_in = 0
+
+    def _neighbor_offsets(self) -> numpy.ndarray:
+        '''Packed key offsets of every voxel within radius'''
+        reach = math.ceil(self.radius / self.voxel_size)
+        offsets = []
+        for d in itertools.product(range(-reach, reach + 1), repeat=3):
+            # closest two points in the voxels could be
+            gap = [max(abs(x) - 1, 0) * self.voxel_size for x in d]
+            if math.sqrt(sum(g * g for g in gap)) <= self.radius:
+                offsets.append(_offset_key(*d))
+        return numpy.array(offsets, dtype=numpy.int64)
+
+    def add(self, points: numpy.ndarray) -> None:
+        '''Merge a slice worth of (n, 3) points into the grid'''
+        if not len(points):
+            return
+        self.n_in += len(points)
+        keys = pack_voxels(numpy.floor(points / self.voxel_size))
+        keys = numpy.concatenate([self.keys, keys])
+        self.keys, inverse = numpy.unique(keys, return_inverse=True)
+        # old voxels come first in keys, so their inverse is the first part
+        old = len(self.counts)
+        counts = numpy.bincount(inverse, minlength=len(self.keys))
+        counts[inverse[:old]] += self.counts - 1
+        sums = numpy.empty((len(self.keys), 3))
+        for axis in range(3):
+            column = numpy.concatenate([self.sums[:, axis], points[:, axis]])
+            sums[:, axis] = numpy.bincount(
+                inverse, weights=column, minlength=len(self.keys))
+        self.sums = sums
+        self.counts = counts
+
+    def neighbor_counts(self) -> numpy.ndarray:
+        '''Number of other points within radius of each voxel'''
+        total = numpy.zeros(len(self.keys), dtype=numpy.int64)
+        if not len(self.keys):
+            return total
+        for offset in self._offsets:
+            idx = numpy.searchsorted(self.keys, self.keys + offset)
+            idx = numpy.minimum(idx, len(self.keys) - 1)
+            found = self.keys[idx] == self.keys + offset
+            total[found] += self.counts[idx[found]]
+        return total - 1
+
+    def inliers(self) -> numpy.ndarray:
+        '''Mask of voxels that aren't outliers'''
+        if not self.min_neighbors:
+            return numpy.ones(len(self.keys), dtype=bool)
+        return self.neighbor_counts() >= self.min_neighbors
+
+    def points(self) -> numpy.ndarray:
+        '''Filtered cloud, the centroid of each inlier voxel'''
+        keep = self.inliers()
+        return self.sums[keep] / self.counts[keep, None]
+
+    def stats(self) -> dict:
+        n_out = int(numpy.count_nonzero(self.inliers()))
+        return {
+            'points_in': self.n_in,
+            'voxels': len(self.keys),
+            'points_out': n_out,
+            'reduction': 1 - n_out / self.n_in if self.n_in else 0,
+        }